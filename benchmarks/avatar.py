@@ -0,0 +1,36 @@
+"""
+Benchmark the cost of rendering an assistant message with an avatar, which
+happens once per streamed delta for a message being written and once per
+rerun for every message on screen.
+
+    python benchmarks/avatar.py [--size 1024] [--renders 500]
+"""
+import os, time, logging, argparse, tempfile
+import streamlit as st
+from PIL import Image
+import canu
+
+def render(container, renders):
+    start = time.perf_counter()
+    for _ in range(renders):
+        container._write_blocks()
+    return (time.perf_counter() - start) / renders
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--renders", type=int, default=500)
+    args = parser.parse_args()
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "avatar.png")
+        Image.effect_noise((args.size, args.size), 64).convert("RGB").save(path)
+        st.session_state.assistant_avatar = path
+        container = canu.Container("assistant", [canu.Block("text", "Hello, world!")])
+
+        cached = render(container, args.renders)
+        container._get_avatar = lambda: Image.open(path)
+        uncached = render(container, args.renders)
+
+    print(f"{'Image.open per render':<24} {uncached * 1000:8.3f} ms/render")
+    print(f"{'canu.get_avatar':<24} {cached * 1000:8.3f} ms/render")
@@ -0,0 +1,38 @@
+"""
+Measure the time it takes to import canu with `python -X importtime` and
+list the slowest modules. Exits with status 1 if the import takes longer
+than `--max-ms`, so it can be used to catch regressions.
+
+    python benchmarks/import_time.py [--top 15] [--max-ms 0]
+"""
+import sys, argparse, subprocess
+
+OPTIONAL = ["boto3", "botocore", "mysql.connector", "xlrd", "openpyxl", "langchain_google_community"]
+
+def measure(module="canu"):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, default=0)
+    args = parser.parse_args()
+    times = measure()
+    for name, ms in sorted(times.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"{name:<48} {ms:10.1f} ms")
+    loaded = [x for x in OPTIONAL if x in times]
+    print(f"\nimport canu: {times['canu']:.1f} ms")
+    print(f"optional backends imported: {', '.join(loaded) if loaded else 'none'}")
+    if args.max_ms and times["canu"] > args.max_ms:
+        sys.exit(1)
@@ -0,0 +1,234 @@
+"""
+Benchmark canu's hot paths without network access, using
+`canu.testing.FakeOpenAI` in place of the OpenAI API and moto in place of S3.
+Streaming and file uploads run the app headlessly with Streamlit's `AppTest`.
+
+    python benchmarks/offline.py [--runs 20] [--chars 2000] [--delay 0] [--latency 0]
+                                 [--fanout 4] [--only streaming,fanout,history,files,locked]
+
+`--delay` is the time between streamed deltas and `--latency` the time of
+every API call, both in seconds. The fan-out benchmark streams one prompt
+to `--fanout` threads one after another and concurrently with
+`canu.write_streams`. Requires moto for the S3 history and xlwt
+for the .xls conversions.
+"""
+import os, time, logging, argparse, datetime, tempfile, statistics
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+import canu
+from canu import history, converters, metrics, testing
+
+CHAT_APP = """
+import streamlit as st
+import canu
+if "containers" not in st.session_state:
+    st.session_state.containers = []
+    st.session_state.download_button_key = 0
+    st.session_state.thread = st.session_state.client.beta.threads.create()
+    st.session_state.assistant = st.session_state.client.beta.assistants.create(name="canu")
+if prompt := st.chat_input("Message"):
+    canu.add_message("user", prompt)
+    canu.write_stream()
+"""
+
+FANOUT_APP = """
+import streamlit as st
+import canu
+if "containers" not in st.session_state:
+    st.session_state.containers = []
+    st.session_state.download_button_key = 0
+    st.session_state.thread = st.session_state.client.beta.threads.create()
+    st.session_state.assistant = st.session_state.client.beta.assistants.create(name="canu")
+if prompt := st.chat_input("Message"):
+    runs = [(st.session_state.client.beta.threads.create().id, st.session_state.assistant.id) for _ in range(st.session_state.fanout)]
+    if prompt == "sync":
+        for thread_id, _ in runs:
+            st.session_state.thread = st.session_state.thread.construct(id=thread_id)
+            canu.write_stream()
+    else:
+        canu.write_streams(runs, client=st.session_state.async_client)
+"""
+
+FILES_APP = """
+import streamlit as st
+import canu
+if "containers" not in st.session_state:
+    st.session_state.containers = []
+    st.session_state.upload_ids = {}
+    st.session_state.file_uploader_key = 0
+    st.session_state.language = "English"
+    st.session_state.thread = st.session_state.client.beta.threads.create()
+canu.handle_files()
+"""
+
+def report(name, latencies, unit="op"):
+    """
+    Print the throughput and latency percentiles of a list of timings.
+    """
+    if len(latencies) > 1:
+        p50, p95 = (statistics.quantiles(latencies, n=20, method="inclusive")[i] for i in (9, 18))
+    else:
+        p50 = p95 = latencies[0]
+    print(f"{name:<32} {len(latencies) / sum(latencies):10,.1f} {unit}/s   p50 {p50 * 1000:9.2f} ms   p95 {p95 * 1000:9.2f} ms")
+
+def histogram_mean(name):
+    for histogram in metrics.snapshot()['histograms']:
+        if histogram['name'] == name and histogram['count']:
+            return histogram['sum'] / histogram['count']
+    return float("nan")
+
+def bench_streaming(args):
+    client = testing.FakeOpenAI(latency=args.latency, delay=args.delay)
+    at = AppTest.from_string(CHAT_APP, default_timeout=600)
+    at.session_state.client = client
+    at.run()
+    reply = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (args.chars // 57 + 1))[:args.chars]
+    scripts = {
+        "text": [testing.text(reply)],
+        "text, code and image": [testing.text(reply[:len(reply) // 2]), testing.code("import pandas as pd\n" * 20), testing.image("file-chart"), testing.text(reply[len(reply) // 2:])],
+        "citations and files": [testing.text(reply), testing.citation("file-doc", "doc.pdf"), testing.file_path("file-csv", "out.csv", b"a,b\n" * 1000)],
+        "function call": [testing.function("unknown_function"), testing.text(reply)],
+    }
+    for name, script in scripts.items():
+        metrics.registry.reset()
+        latencies = []
+        for _ in range(args.runs):
+            client.queue(*script)
+            at.session_state.containers = []
+            start = time.perf_counter()
+            at.chat_input[0].set_value("Hello").run()
+            latencies.append(time.perf_counter() - start)
+            assert not at.exception, at.exception
+        report(f"stream: {name}", latencies, "run")
+        deltas = sum(len(x.get('value', x.get('input', ''))) for x in script) / client.chunk_size
+        print(f"{'':<32} {deltas * len(latencies) / sum(latencies):10,.0f} deltas/s   ttft {histogram_mean('canu_time_to_first_token_seconds') * 1000:7.2f} ms   {histogram_mean('canu_renders_per_run'):6.1f} renders/run")
+
+def bench_fanout(args):
+    client = testing.FakeOpenAI(latency=args.latency, delay=args.delay or 0.001)
+    at = AppTest.from_string(FANOUT_APP, default_timeout=600)
+    at.session_state.client = client
+    at.session_state.async_client = testing.FakeAsyncOpenAI(client)
+    at.session_state.fanout = args.fanout
+    at.run()
+    reply = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (args.chars // 57 + 1))[:args.chars]
+    for mode in ["sync", "async"]:
+        latencies = []
+        for _ in range(args.runs):
+            for _ in range(args.fanout):
+                client.queue(testing.text(reply))
+            at.session_state.containers = []
+            start = time.perf_counter()
+            at.chat_input[0].set_value(mode).run()
+            latencies.append(time.perf_counter() - start)
+            assert not at.exception, at.exception
+        report(f"fan out to {args.fanout} threads: {mode}", latencies, "prompt")
+
+def conversation(turns):
+    data = []
+    for i in range(turns):
+        data.append(["user", [{'type': 'text', 'content': f"Question {i}"}]])
+        blocks = [{'type': 'text', 'content': "Answer. " * 100}]
+        if i % 10 == 0:
+            blocks.append({'type': 'image', 'content': os.urandom(64 * 1024)})
+        data.append(["assistant", blocks])
+    return data
+
+def bench_store(name, store, args):
+    data = conversation(args.turns)
+    saves, loads = [], []
+    for i in range(args.runs):
+        start = time.perf_counter()
+        history.save_conversation(store, "user", f"conversation{i}", data)
+        saves.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        history.load_conversation(store, "user", f"conversation{i}")
+        loads.append(time.perf_counter() - start)
+    report(f"history {name}: save", saves)
+    report(f"history {name}: load", loads)
+
+def bench_history(args):
+    with tempfile.TemporaryDirectory() as t:
+        bench_store("LOCAL", history.LocalHistory(root=t), args)
+    from moto import mock_aws
+    import boto3
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="canu-benchmark")
+        history.get_s3_client.cache_clear()
+        bench_store("S3", history.S3History("canu-benchmark", "users", "key", "secret"), args)
+        bench_store("S3, compressed", history.S3History("canu-benchmark", "compressed", "key", "secret", compression=True), args)
+        history.get_s3_client.cache_clear()
+
+def xls(rows, seed=0):
+    import io
+    import xlwt
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet("Sheet1")
+    date_style = xlwt.easyxf(num_format_str="YYYY-MM-DD")
+    for row in range(rows):
+        ws.write(row, 0, row + seed)
+        ws.write(row, 1, f"text {row}")
+        ws.write(row, 2, datetime.datetime(2024, 1, 1) + datetime.timedelta(days=row), date_style)
+    f = io.BytesIO()
+    wb.save(f)
+    return f.getvalue()
+
+def bench_files(args):
+    for cache in ["cold", "warm"]:
+        latencies = []
+        for i in range(args.runs):
+            client = testing.FakeOpenAI(latency=args.latency)
+            at = AppTest.from_string(FILES_APP, default_timeout=600)
+            at.session_state.client = client
+            at.run()
+            # Vary the content unless measuring the conversion cache.
+            workbooks = [xls(args.rows, seed=(i * args.files + j) if cache == "cold" else -1) for j in range(args.files)]
+            files = [(f"table{j}.xls", x, "application/vnd.ms-excel") for j, x in enumerate(workbooks)]
+            files.append(("notes.txt", f"Notes {i}".encode(), "text/plain"))
+            start = time.perf_counter()
+            at.file_uploader[0].set_value(files).run()
+            latencies.append(time.perf_counter() - start)
+            assert not at.exception, at.exception
+        report(f"handle_files: {args.files} .xls, {cache}", latencies, "batch")
+
+def bench_locked(args):
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    client = testing.FakeOpenAI(latency=args.latency)
+    st.session_state.client = client
+    st.session_state.thread = client.beta.threads.create()
+    runs = args.runs * 100
+    cases = {
+        "known, finished": lambda: None,
+        "unknown": lambda: st.session_state.pop("run_state", None),
+    }
+    for name, prepare in cases.items():
+        canu.is_thread_locked()
+        calls = sum(client.calls.values())
+        latencies = []
+        for _ in range(runs):
+            prepare()
+            start = time.perf_counter()
+            canu.is_thread_locked()
+            latencies.append(time.perf_counter() - start)
+        report(f"is_thread_locked: {name}", latencies, "call")
+        print(f"{'':<32} {(sum(client.calls.values()) - calls) / runs:10.2f} API calls/call")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--chars", type=int, default=2000)
+    parser.add_argument("--delay", type=float, default=0)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--only", default="streaming,fanout,history,files,locked")
+    args = parser.parse_args()
+    benchmarks = {"streaming": bench_streaming, "fanout": bench_fanout, "history": bench_history, "files": bench_files, "locked": bench_locked}
+    with tempfile.TemporaryDirectory() as t:
+        # Start from an empty upload index and conversion cache.
+        canu.upload_index = canu.UploadIndex(os.path.join(t, "uploads.db"))
+        converters.service.cache_dir = os.path.join(t, "conversions")
+        for name in args.only.split(","):
+            benchmarks[name](args)
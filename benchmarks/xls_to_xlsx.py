@@ -0,0 +1,73 @@
+"""
+Benchmark the .xls to .xlsx conversion on generated workbooks.
+
+    python benchmarks/xls_to_xlsx.py [--rows 60000] [--cols 10] [--sheets 3] [--files 4]
+
+Requires xlwt to generate the input workbooks.
+"""
+import os, time, argparse, datetime, tempfile
+import xlrd
+import xlwt
+import openpyxl
+from canu import converters
+
+def generate(path, rows, cols, sheets):
+    wb = xlwt.Workbook()
+    date_style = xlwt.easyxf(num_format_str="YYYY-MM-DD")
+    start = datetime.datetime(2024, 1, 1)
+    for i in range(sheets):
+        ws = wb.add_sheet(f"Sheet{i + 1}")
+        for row in range(rows):
+            for col in range(cols):
+                if col % 3 == 0:
+                    ws.write(row, col, row * cols + col)
+                elif col % 3 == 1:
+                    ws.write(row, col, f"text {row}-{col}")
+                else:
+                    ws.write(row, col, start + datetime.timedelta(days=row), date_style)
+    wb.save(path)
+
+def convert_cell_by_cell(src, dst):
+    """
+    The conversion used before `canu.converters`, kept as a baseline.
+    """
+    wb1 = xlrd.open_workbook(src)
+    wb2 = openpyxl.Workbook()
+    for sheet_name in wb1.sheet_names():
+        sheet1 = wb1.sheet_by_name(sheet_name)
+        sheet2 = wb2.create_sheet(title=sheet_name)
+        for row in range(sheet1.nrows):
+            for col in range(sheet1.ncols):
+                sheet2.cell(row=row+1, column=col+1, value=sheet1.cell_value(row, col))
+    wb2.remove(wb2['Sheet'])
+    wb2.save(dst)
+
+def report(name, seconds, rows):
+    print(f"{name:<24} {seconds:8.2f} s {rows / seconds:12,.0f} rows/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=60000)
+    parser.add_argument("--cols", type=int, default=10)
+    parser.add_argument("--sheets", type=int, default=3)
+    parser.add_argument("--files", type=int, default=4)
+    args = parser.parse_args()
+    rows = args.rows * args.sheets
+    with tempfile.TemporaryDirectory() as t:
+        paths = [os.path.join(t, f"workbook{i}.xls") for i in range(args.files)]
+        generate(paths[0], args.rows, args.cols, args.sheets)
+        for path in paths[1:]:
+            with open(paths[0], 'rb') as f1, open(path, 'wb') as f2:
+                f2.write(f1.read())
+
+        start = time.perf_counter()
+        convert_cell_by_cell(paths[0], os.path.join(t, "baseline.xlsx"))
+        report("cell by cell", time.perf_counter() - start, rows)
+
+        start = time.perf_counter()
+        converters.xls_to_xlsx(paths[0], os.path.join(t, "streamed.xlsx"))
+        report("streamed", time.perf_counter() - start, rows)
+
+        start = time.perf_counter()
+        converters.convert_xls_files(paths)
+        report(f"streamed, {args.files} processes", time.perf_counter() - start, rows * args.files)
@@ -1,137 +1,569 @@
-import os, time, yaml, pickle, tempfile
+import io, os, copy, time, yaml, asyncio, hashlib, tempfile, functools, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import streamlit_authenticator as stauth
 import openai
-import mysql.connector
-from PIL import Image
-import boto3
-import xlrd
-import openpyxl
+from .cache import LRUCache
+from . import history, converters, functions, metrics
+from .uploads import UploadIndex
+from .spool import Spool, SpooledFile, SpoolSession
+
+# Shared by all sessions in the process; file ids are globally unique.
+file_cache = LRUCache(max_entries=1024, ttl=3600)
+file_content_cache = LRUCache(max_entries=256, max_bytes=256 * 1024 * 1024, ttl=3600)
+upload_index = UploadIndex()
+spool = Spool()
+avatar_cache = LRUCache(max_entries=32)
+yaml_cache = {}
+yaml_lock = threading.RLock()
+# Since Streamlit 1.52, st.download_button accepts a callable which is only 
+# run when the button is clicked.
+deferred_downloads = tuple(int(x) for x in st.__version__.split(".")[:2]) >= (1, 52)
+mysql_user_cache = LRUCache(max_entries=10000, ttl=60)
+mysql_pools = {}
+mysql_pools_lock = threading.Lock()
+
+class Block():
+    """
+    A single block (text, code or image) of a message. Streamed content is 
+    kept as a list of chunks which is only joined when the content is read, 
+    and the joined result is cached until the next append. Blocks restored 
+    from the history's blob store load their content on first access.
+    """
+    __slots__ = ('type', '_chunks', '_content', '_size', '_loader', 'digest')
+
+    def __init__(self, type, content=""):
+        self.type = type
+        self._chunks = [content] if content else []
+        self._content = content
+        self._size = len(content)
+        self._loader = None
+        self.digest = None
+
+    def __len__(self):
+        return self._size
+
+    def __reduce__(self):
+        return (Block, (self.type, self.content))
+
+    @property
+    def content(self):
+        if self._content is None:
+            if self._loader is not None:
+                self._content = self._loader()
+                self._loader = None
+            else:
+                self._content = "".join(self._chunks)
+            self._chunks = [self._content]
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._chunks = [value] if value else []
+        self._content = value
+        self._size = len(value)
+        self._loader = None
+        self.digest = None
+
+    def append(self, chunk):
+        """
+        Append a chunk of streamed content to the block.
+        """
+        if self._loader is not None:
+            self.content
+        self._chunks.append(chunk)
+        self._content = None
+        self._size += len(chunk)
+        self.digest = None
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def detach(self):
+        """
+        Load the content of a block restored from the blob store and stop 
+        referring to the blob, e.g. before the blob is deleted. The content 
+        is stored again if the block is saved.
+        """
+        self.content
+        self.digest = None
+
+    def unload(self, loader):
+        """
+        Drop the content from memory. It is loaded by calling `loader()` when 
+        it is next read.
+        """
+        self._chunks = []
+        self._content = None
+        self._loader = loader
+
+    def to_dict(self):
+        """
+        Return the block in the `{'type': ..., 'content': ...}` form used by 
+        saved conversations. Content restored from the blob store is 
+        referenced by its digest instead of being loaded.
+        """
+        if self.digest is not None:
+            return {'type': self.type, 'blob': self.digest, 'size': self._size}
+        return {'type': self.type, 'content': self.content}
+
+    @classmethod
+    def from_dict(cls, data, get_blob=None):
+        if 'blob' in data:
+            return cls.from_blob(data['type'], data['blob'], data['size'], lambda: get_blob(data['blob']))
+        return cls(data['type'], data['content'])
+
+    @classmethod
+    def from_blob(cls, type, digest, size, loader):
+        """
+        Create a block whose content is loaded by calling `loader()` when it 
+        is first read.
+        """
+        block = cls(type)
+        block._content = None
+        block._size = size
+        block._loader = loader
+        block.digest = digest
+        return block
 
 class Container():
-    def __init__(self, role, blocks, show_code_block=True, show_download_button=True):
+    def __init__(self, role, blocks, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512):
         self.container = st.empty()
         self.role = role
-        self.blocks = blocks
+        self.blocks = [x if isinstance(x, Block) else Block.from_dict(x) for x in blocks]
         self.show_code_block = show_code_block
         self.show_download_button = show_download_button
         self.code_interpreter_files = {}
+        self.render_interval = render_interval
+        self.render_bytes = render_bytes
+        self.message = None
+        self.placeholders = []
+        self.files_placeholder = None
+        self.rendered_size = 0
+        self.last_render = 0
+        self.run_metrics = None
 
-    def _write_blocks(self):
+    def _get_avatar(self):
         avatar = None
         if self.role == "assistant" and "assistant_avatar" in st.session_state:
-            avatar = Image.open(st.session_state.assistant_avatar)
-        with st.chat_message(self.role, avatar=avatar):
+            avatar = get_avatar(st.session_state.assistant_avatar)
+        return avatar
+
+    def _write_block(self, block):
+        if block.type == 'text':
+            st.write(block.content, unsafe_allow_html=True)
+        elif block.type == 'code' and self.show_code_block:
+            st.code(block.content)
+        elif block.type == 'image':
+            st.image(block.content)
+
+    def _write_download_buttons(self):
+        if self.code_interpreter_files and self.show_download_button:
+            for filename, content in self.code_interpreter_files.items():
+                if isinstance(content, SpooledFile):
+                    content = content.read if deferred_downloads else content.read()
+                if filename.endswith('.csv'):
+                    mime = "text/csv"
+                elif filename.endswith('.png'):
+                    mime = "image/png"
+                else:
+                    mime = "text/plain"
+                st.download_button(
+                    label=f"{filename}",
+                    data=content,
+                    file_name=filename,
+                    mime=mime,
+                    key=f"download_button_{st.session_state.download_button_key}"
+                )
+                st.session_state.download_button_key += 1
+
+    def _record_render(self, mode, start):
+        metrics.observe("canu_render_seconds", time.perf_counter() - start, mode=mode)
+        metrics.inc("canu_renders_total", mode=mode)
+        if self.run_metrics is not None:
+            self.run_metrics.renders += 1
+
+    def _write_blocks(self):
+        start = time.perf_counter()
+        with st.chat_message(self.role, avatar=self._get_avatar()):
             for block in self.blocks:
-                if block['type'] == 'text':
-                    st.write(block['content'], unsafe_allow_html=True)
-                elif block['type'] == 'code' and self.show_code_block:
-                    st.code(block['content'])
-                elif block['type'] == 'image':
-                    st.image(block['content'])
-            if self.code_interpreter_files and self.show_download_button:
-                for filename, content in self.code_interpreter_files.items():
-                    if filename.endswith('.csv'):
-                        mime = "text/csv"
-                    elif filename.endswith('.png'):
-                        mime = "image/png"
-                    else:
-                        mime = "text/plain"
-                    st.download_button(
-                        label=f"{filename}",
-                        data=content,
-                        file_name=filename,
-                        mime=mime,
-                        key=f"download_button_{st.session_state.download_button_key}"
-                    )
-                    st.session_state.download_button_key += 1
+                self._write_block(block)
+            self._write_download_buttons()
+        self._record_render("full", start)
+
+    def _write_tail(self):
+        """
+        Render only the blocks that changed since the last streamed render.
+        Blocks are only ever appended to at the tail, so everything before 
+        the previously rendered tail block is final.
+        """
+        start = time.perf_counter()
+        if self.message is None:
+            self.message = self.container.chat_message(self.role, avatar=self._get_avatar())
+        for i in range(max(len(self.placeholders) - 1, 0), len(self.blocks)):
+            if i == len(self.placeholders):
+                self.placeholders.append(self.message.empty())
+            with self.placeholders[i]:
+                self._write_block(self.blocks[i])
+        self.rendered_size = len(self.blocks[-1]) if self.blocks else 0
+        self.last_render = time.monotonic()
+        self._record_render("stream", start)
 
     def get_content(self):
         content = []
         for block in self.blocks:
-            if block['type'] == 'text':
-                content.append({"type": "text", "text": block['content']})
+            if block.type == 'text':
+                content.append({"type": "text", "text": block.content})
         return content
 
     def write_blocks(self, stream=False):
+        """
+        Write the blocks to the page. When streaming, renders are coalesced: 
+        the tail block is only pushed once `render_interval` seconds have 
+        passed or `render_bytes` new bytes have arrived since the last render, 
+        or when a new block is started. Call `flush` to force a final render.
+        """
         if stream:
-            with self.container:
-                self._write_blocks()
+            size = len(self.blocks[-1]) if self.blocks else 0
+            if (
+                len(self.blocks) > len(self.placeholders)
+                or size - self.rendered_size >= self.render_bytes
+                or time.monotonic() - self.last_render >= self.render_interval
+            ):
+                self._write_tail()
         else:
             self._write_blocks()
 
-class EventHandler(openai.AssistantEventHandler):
-    def __init__(self, container=None, show_quotation_marks=True, show_code_block=True, show_download_button=True):
+    def flush(self):
+        """
+        Render any pending streamed content and the download buttons.
+        """
+        self._write_tail()
+        if self.code_interpreter_files and self.show_download_button:
+            if self.files_placeholder is None:
+                self.files_placeholder = self.message.empty()
+            with self.files_placeholder.container():
+                self._write_download_buttons()
+
+class EventHandlerMixin():
+    """
+    The logic shared by `EventHandler` and `AsyncEventHandler`, which only 
+    differ in how they call the API: deltas are written to a `Container`, 
+    and the files they refer to are looked up by the subclasses.
+    """
+    def __init__(self, container=None, show_quotation_marks=True, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512):
         super().__init__()
         self.container = container
         self.redundant = container is not None
         self.show_quotation_marks = show_quotation_marks
         self.show_code_block = show_code_block
         self.show_download_button = show_download_button
+        self.render_interval = render_interval
+        self.render_bytes = render_bytes
+        self.tool_latencies = []
+        self.run_metrics = metrics.RunMetrics()
 
-    def on_text_delta(self, delta, snapshot):
+    def _create_container(self):
         if self.container is None:
-            self.container = Container("assistant", [], show_code_block=self.show_code_block, show_download_button=self.show_download_button)
-        if not self.container.blocks or self.container.blocks[-1]['type'] != 'text':
-            self.container.blocks.append({'type': 'text', 'content': ""})
+            self.container = Container("assistant", [], show_code_block=self.show_code_block, show_download_button=self.show_download_button, render_interval=self.render_interval, render_bytes=self.render_bytes)
+        self.container.run_metrics = self.run_metrics
+
+    def _create_continuation(self, **kwargs):
+        """
+        Create the handler for the stream that follows submitted tool 
+        outputs, which continues the same run.
+        """
+        event_handler = type(self)(self.container, show_quotation_marks=self.show_quotation_marks, show_code_block=self.show_code_block, show_download_button=self.show_download_button, render_interval=self.render_interval, render_bytes=self.render_bytes, **kwargs)
+        event_handler.run_metrics = self.run_metrics
+        return event_handler
+
+    def _get_file_ids(self, delta):
+        """
+        Returns the annotation type and file id of each file referred to by 
+        a text delta.
+        """
+        file_ids = []
+        for annotation in delta.annotations or []:
+            if annotation.type == "file_citation":
+                file_ids.append((annotation.type, annotation.file_citation.file_id))
+            elif annotation.type == "file_path":
+                file_ids.append((annotation.type, annotation.file_path.file_id))
+        return file_ids
+
+    def _write_text_delta(self, delta, files):
+        """
+        Write a text delta. `files` maps the ids of the files it refers to 
+        onto their metadata and, for code interpreter outputs, their 
+        `SpooledFile`.
+        """
+        self._create_container()
+        if not self.container.blocks or self.container.blocks[-1].type != 'text':
+            self.container.blocks.append(Block('text'))
         if delta.annotations is not None:
             for annotation in delta.annotations:
                 if annotation.type == "file_citation":
-                    file = st.session_state.client.files.retrieve(annotation.file_citation.file_id)
+                    file, _ = files[annotation.file_citation.file_id]
                     if self.show_quotation_marks:
                         delta.value = delta.value.replace(annotation.text, f"""<a href="#" title="{file.filename}">[❞]</a>""")
                     else:
                         delta.value = delta.value.replace(annotation.text, "")
                 elif annotation.type == "file_path":
-                    file = st.session_state.client.files.retrieve(annotation.file_path.file_id)
-                    content = st.session_state.client.files.content(file.id)
+                    file, spooled_file = files[annotation.file_path.file_id]
                     filename = os.path.basename(file.filename)
-                    self.container.code_interpreter_files[filename] = content.read()
+                    self.container.code_interpreter_files[filename] = spooled_file
         if delta.value is not None:
-            self.container.blocks[-1]["content"] += delta.value
+            self.container.blocks[-1].append(delta.value)
+            self.run_metrics.token()
         self.container.write_blocks(stream=True)
 
-    def on_image_file_done(self, image_file):
-        if self.container is None:
-            self.container = Container("assistant", [], show_code_block=self.show_code_block, show_download_button=self.show_download_button)
-        if not self.container.blocks or self.container.blocks[-1]['type'] != 'image':
-            self.container.blocks.append({'type': 'image', 'content': ""})
-        image_data = st.session_state.client.files.content(image_file.file_id)
-        image_data_bytes = image_data.read()
-        self.container.blocks[-1]["content"] = image_data_bytes
+    def _write_image(self, content):
+        self._create_container()
+        if not self.container.blocks or self.container.blocks[-1].type != 'image':
+            self.container.blocks.append(Block('image'))
+        self.container.blocks[-1].content = content
         self.container.write_blocks(stream=True)
 
-    def on_tool_call_delta(self, delta, snapshot):
+    def _write_tool_call_delta(self, delta):
         if delta.type == "function":
             pass
         elif delta.type == "code_interpreter":
-            if self.container is None:
-                self.container = Container("assistant", [], show_code_block=self.show_code_block, show_download_button=self.show_download_button)
+            self._create_container()
             if delta.code_interpreter.input:
-                if not self.container.blocks or self.container.blocks[-1]['type'] != 'code':
-                    self.container.blocks.append({'type': 'code', 'content': ""})
-                self.container.blocks[-1]["content"] += delta.code_interpreter.input
+                if not self.container.blocks or self.container.blocks[-1].type != 'code':
+                    self.container.blocks.append(Block('code'))
+                self.container.blocks[-1].append(delta.code_interpreter.input)
+                self.run_metrics.token()
             self.container.write_blocks(stream=True)
 
+    def _end(self):
+        if self.container is not None:
+            self.container.flush()
+            if not self.redundant:
+                st.session_state.containers.append(self.container)
+        self.run_metrics.end()
+
+    def _track_event(self, event):
+        """
+        Record the state of the run from an event. Returns whether the run 
+        requires action.
+        """
+        if event.event == 'thread.run.created':
+            self.run_metrics.start()
+        if event.event == 'thread.run.completed' and event.data.usage is not None:
+            self.run_metrics.completion_tokens = event.data.usage.completion_tokens
+        if event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step.'):
+            # Runs on other threads, e.g. when fanning out with 
+            # `write_streams`, do not lock the session's thread.
+            if "thread" not in st.session_state or event.data.thread_id == st.session_state.thread.id:
+                set_run_state(event.data)
+        return event.event == 'thread.run.requires_action'
+
+class EventHandler(EventHandlerMixin, openai.AssistantEventHandler):
+    def on_text_delta(self, delta, snapshot):
+        files = {}
+        for annotation_type, file_id in self._get_file_ids(delta):
+            files[file_id] = (retrieve_file(file_id), spool_file(file_id) if annotation_type == "file_path" else None)
+        self._write_text_delta(delta, files)
+
+    def on_image_file_done(self, image_file):
+        self._write_image(get_file_content(image_file.file_id))
+
+    def on_tool_call_delta(self, delta, snapshot):
+        self._write_tool_call_delta(delta)
+
     def submit_tool_outputs(self, tool_outputs, run_id):
-        with st.session_state.client.beta.threads.runs.submit_tool_outputs_stream(
+        with metrics.timer("runs.submit_tool_outputs_stream"), st.session_state.client.beta.threads.runs.submit_tool_outputs_stream(
             thread_id=self.current_run.thread_id,
             run_id=self.current_run.id,
             tool_outputs=tool_outputs,
-            event_handler=EventHandler(self.container),
+            event_handler=self._create_continuation(),
         ) as stream:
             stream.until_done()
 
+    def handle_requires_action(self, data, run_id):
+        """
+        Run the function tools requested by the run concurrently and submit 
+        all of their outputs at once.
+        """
+        tool_calls = data.required_action.submit_tool_outputs.tool_calls
+        tool_outputs, latencies = functions.dispatch(tool_calls)
+        self.tool_latencies.extend(latencies)
+        self.submit_tool_outputs(tool_outputs, run_id)
+
     def on_end(self):
-        if self.container is not None and not self.redundant:
-            st.session_state.containers.append(self.container)
+        self._end()
 
     def on_event(self, event):
-        if event.event == 'thread.run.requires_action':
+        if self._track_event(event):
             run_id = event.data.id
             self.handle_requires_action(event.data, run_id)
 
+class AsyncEventHandler(EventHandlerMixin, openai.AsyncAssistantEventHandler):
+    """
+    An `EventHandler` for streams of an `openai.AsyncOpenAI` client, so that 
+    several runs can be streamed concurrently in one event loop. It must run 
+    in the script thread, since it writes to the page. Files are looked up 
+    with `client`; if it is not given, `canu.write_stream_async` opens a 
+    client for the run and closes it afterwards.
+    """
+    def __init__(self, container=None, show_quotation_marks=True, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512, client=None):
+        super().__init__(container, show_quotation_marks=show_quotation_marks, show_code_block=show_code_block, show_download_button=show_download_button, render_interval=render_interval, render_bytes=render_bytes)
+        self.client = client
+
+    def _create_continuation(self):
+        return super()._create_continuation(client=self.client)
+
+    async def on_text_delta(self, delta, snapshot):
+        files = {}
+        for annotation_type, file_id in self._get_file_ids(delta):
+            files[file_id] = (await retrieve_file_async(file_id, self.client), await spool_file_async(file_id, self.client) if annotation_type == "file_path" else None)
+        self._write_text_delta(delta, files)
+
+    async def on_image_file_done(self, image_file):
+        self._write_image(await get_file_content_async(image_file.file_id, self.client))
+
+    async def on_tool_call_delta(self, delta, snapshot):
+        self._write_tool_call_delta(delta)
+
+    async def submit_tool_outputs(self, tool_outputs, run_id):
+        with metrics.timer("runs.submit_tool_outputs_stream"):
+            async with self.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=self.current_run.thread_id,
+                run_id=self.current_run.id,
+                tool_outputs=tool_outputs,
+                event_handler=self._create_continuation(),
+            ) as stream:
+                await stream.until_done()
+
+    async def handle_requires_action(self, data, run_id):
+        """
+        Run the function tools requested by the run in worker threads, so 
+        that other runs keep streaming, and submit all of their outputs at 
+        once.
+        """
+        tool_calls = data.required_action.submit_tool_outputs.tool_calls
+        tool_outputs, latencies = await asyncio.to_thread(functions.dispatch, tool_calls)
+        self.tool_latencies.extend(latencies)
+        await self.submit_tool_outputs(tool_outputs, run_id)
+
+    async def on_end(self):
+        self._end()
+
+    async def on_event(self, event):
+        if self._track_event(event):
+            run_id = event.data.id
+            await self.handle_requires_action(event.data, run_id)
+
+class MySQLConnection():
+    """
+    A connection from `canu.get_mysql_connection`. Closing it returns it to 
+    the pool and lets the next waiting caller take it.
+    """
+    def __init__(self, connection, semaphore):
+        self._connection = connection
+        self._semaphore = semaphore
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._semaphore is None:
+            return
+        try:
+            self._connection.close()
+        finally:
+            self._semaphore.release()
+            self._semaphore = None
+
+def get_mysql_connection():
+    """
+    Returns a connection from the MySQL connection pool shared by all 
+    sessions. Closing the connection returns it to the pool. If all 
+    connections are in use, waits up to `pool_timeout` seconds for one to 
+    be returned instead of failing at once.
+    """
+    import mysql.connector.errors
+    import mysql.connector.pooling
+    config = st.session_state.config['authentication']
+    key = (config['host'], config['database'], config['user'])
+    with mysql_pools_lock:
+        if key not in mysql_pools:
+            pool_size = config.get('pool_size', 5)
+            pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name=f"canu_{len(mysql_pools)}",
+                pool_size=pool_size,
+                user=config['user'],
+                password=config['password'],
+                host=config['host'],
+                database=config['database']
+            )
+            mysql_pools[key] = (pool, threading.BoundedSemaphore(pool_size))
+    pool, semaphore = mysql_pools[key]
+    if not semaphore.acquire(timeout=config.get('pool_timeout', 30)):
+        raise mysql.connector.errors.PoolError("Timed out waiting for a connection from the pool")
+    try:
+        return MySQLConnection(pool.get_connection(), semaphore)
+    except BaseException:
+        semaphore.release()
+        raise
+
+def get_mysql_user(username):
+    """
+    Returns the name and password of a user from the MySQL database, or None 
+    if the user does not exist. Results are cached for a short time.
+    """
+    import mysql.connector
+    user = mysql_user_cache.get(username, False)
+    if user is not False:
+        return user
+    try:
+        connection = get_mysql_connection()
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(f"SELECT name, password FROM {st.session_state.config['authentication']['table']} WHERE username = %s", (username,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            connection.close()
+    except mysql.connector.Error as e:
+        st.error(f"Error connecting to MySQL database: {e}")
+        return None
+    user = None if row is None else {'name': row['name'], 'password': row['password']}
+    mysql_user_cache.set(username, user)
+    return user
+
+class MySQLCredentials(dict):
+    """
+    The 'usernames' credentials of the authenticator when using MySQL 
+    authentication. A user's row is fetched the first time the user is 
+    looked up instead of loading the whole table up front. Plaintext 
+    passwords are hashed as the authenticator does for preloaded 
+    credentials.
+    """
+    def _fetch(self, username):
+        user = get_mysql_user(username)
+        if user is None:
+            return False
+        user = dict(user)
+        if not stauth.Hasher.is_hash(user['password']):
+            user['password'] = stauth.Hasher.hash(user['password'])
+        dict.__setitem__(self, username, user)
+        return True
+
+    def __contains__(self, username):
+        return dict.__contains__(self, username) or self._fetch(username)
+
+    def __missing__(self, username):
+        if self._fetch(username):
+            return dict.__getitem__(self, username)
+        raise KeyError(username)
+
+    def get(self, username, default=None):
+        return self[username] if username in self else default
+
 def authenticate():
     """
     Create an authenticator object based on the authentication method 
@@ -139,10 +571,9 @@ def authenticate():
     'YAML' and 'MYSQL'.
     """
     def from_yaml():
-        with open("./auth.yaml") as f:
-            config = yaml.load(f, Loader=yaml.loader.SafeLoader)
+        config = load_yaml("./auth.yaml")
         authenticator = stauth.Authenticate(
-            config['credentials'],
+            copy.deepcopy(config['credentials']),
             config['cookie']['cookie_name'],
             config['cookie']['cookie_key'],
             config['cookie']['cookie_expiry_days'],
@@ -150,25 +581,8 @@ def authenticate():
         return authenticator
     
     def from_mysql():
-        try:
-            connection = mysql.connector.connect(
-                user=st.session_state.config['authentication']['user'],
-                password=st.session_state.config['authentication']['password'],
-                host=st.session_state.config['authentication']['host'],
-                database=st.session_state.config['authentication']['database']
-            )
-            if connection.is_connected():
-                cursor = connection.cursor(dictionary=True)
-                cursor.execute(f"SELECT username, name, password FROM {st.session_state.config['authentication']['table']}")
-                result = cursor.fetchall()
-                credentials = {'usernames': {row['username']: {'name': row['name'], 'password': row['password']} for row in result}}
-                cursor.close()
-        except mysql.connector.Error as e:
-            st.error(f"Error connecting to MySQL database: {e}")
-        finally:
-            if connection.is_connected():
-                connection.close()
-        authenticator = stauth.Authenticate(credentials, '', '', 0)
+        authenticator = stauth.Authenticate({'usernames': {}}, '', '', 0)
+        authenticator.authentication_handler.credentials['usernames'] = MySQLCredentials()
         return authenticator
 
     if "page" not in st.session_state:
@@ -187,20 +601,189 @@ def authenticate():
 def add_message(role, content):
     create_message(role, content)
     st.session_state.containers.append(
-        Container(role, [{'type': 'text', 'content': content}])
+        Container(role, [Block('text', content)])
     )
 
-def write_stream(event_handler=None, show_quotation_marks=True, show_code_block=True, show_download_button=True):
+def write_stream(event_handler=None, show_quotation_marks=True, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512):
     if event_handler is None:
-        event_handler = EventHandler(show_quotation_marks=show_quotation_marks, show_code_block=show_code_block, show_download_button=show_download_button)
+        event_handler = EventHandler(show_quotation_marks=show_quotation_marks, show_code_block=show_code_block, show_download_button=show_download_button, render_interval=render_interval, render_bytes=render_bytes)
     if not is_thread_locked():
-        with st.session_state.client.beta.threads.runs.stream(
+        event_handler.run_metrics.start()
+        with metrics.timer("runs.stream"), st.session_state.client.beta.threads.runs.stream(
             thread_id=st.session_state.thread.id,
             assistant_id=st.session_state.assistant.id,
             event_handler=event_handler,
         ) as stream:
             stream.until_done()
 
+async def write_stream_async(event_handler=None, thread_id=None, assistant_id=None, client=None, show_quotation_marks=True, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512):
+    """
+    Stream a run like `canu.write_stream`, but on an `openai.AsyncOpenAI` 
+    client. Several runs, e.g. of different assistants or threads, can be 
+    streamed concurrently with `asyncio.gather`, each into the container of 
+    its own `canu.AsyncEventHandler`. `thread_id` and `assistant_id` default 
+    to those of the session. If neither `client` nor the event handler's 
+    client is given, a new `openai.AsyncOpenAI` client is used for the run 
+    and closed afterwards.
+    """
+    if event_handler is None:
+        event_handler = AsyncEventHandler(show_quotation_marks=show_quotation_marks, show_code_block=show_code_block, show_download_button=show_download_button, render_interval=render_interval, render_bytes=render_bytes, client=client)
+    if thread_id is None:
+        thread_id = st.session_state.thread.id
+    if assistant_id is None:
+        assistant_id = st.session_state.assistant.id
+    # Only the session's thread is tracked locally.
+    if thread_id == st.session_state.thread.id and await to_thread(is_thread_locked):
+        return
+    if event_handler.client is None:
+        async with create_async_client() as client:
+            event_handler.client = client
+            try:
+                await _stream_async(event_handler, thread_id, assistant_id)
+            finally:
+                event_handler.client = None
+    else:
+        await _stream_async(event_handler, thread_id, assistant_id)
+
+async def _stream_async(event_handler, thread_id, assistant_id):
+    event_handler.run_metrics.start()
+    with metrics.timer("runs.stream"):
+        async with event_handler.client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            event_handler=event_handler,
+        ) as stream:
+            await stream.until_done()
+
+async def to_thread(func, *args, **kwargs):
+    """
+    Run a blocking function in a worker thread like `asyncio.to_thread`, 
+    with access to the session state of the current script run.
+    """
+    ctx = get_script_run_ctx()
+    def run():
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, ctx)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_script_run_ctx(thread, None)
+    return await asyncio.to_thread(run)
+
+def write_streams(runs, client=None, show_quotation_marks=True, show_code_block=True, show_download_button=True, render_interval=0.1, render_bytes=512):
+    """
+    Stream several runs concurrently, given as `(thread_id, assistant_id)` 
+    pairs, and return their event handlers in the same order. The messages 
+    are laid out in the order of `runs`. If `client` is not given, a new 
+    `openai.AsyncOpenAI` client is used and closed afterwards.
+    """
+    async def main(client):
+        event_handlers = []
+        for _ in runs:
+            event_handler = AsyncEventHandler(show_quotation_marks=show_quotation_marks, show_code_block=show_code_block, show_download_button=show_download_button, render_interval=render_interval, render_bytes=render_bytes, client=client)
+            # Lay out the containers up front and add them to the session in 
+            # the same order, rather than in the order the runs finish.
+            event_handler._create_container()
+            event_handler.redundant = True
+            event_handlers.append(event_handler)
+        await asyncio.gather(*[
+            write_stream_async(event_handler, thread_id=thread_id, assistant_id=assistant_id)
+            for event_handler, (thread_id, assistant_id) in zip(event_handlers, runs)
+        ])
+        for event_handler in event_handlers:
+            if event_handler.container.blocks:
+                st.session_state.containers.append(event_handler.container)
+        return event_handlers
+
+    async def main_with_client():
+        async with create_async_client() as client:
+            return await main(client)
+
+    if client is not None:
+        return asyncio.run(main(client))
+    return asyncio.run(main_with_client())
+
+def create_async_client():
+    """
+    Create an `openai.AsyncOpenAI` client with the settings of 
+    `st.session_state.client`. A client is bound to the event loop it is 
+    first used in, so one is needed per `asyncio.run`.
+    """
+    client = st.session_state.client
+    return openai.AsyncOpenAI(api_key=client.api_key, organization=client.organization, project=client.project, base_url=client.base_url)
+
+def get_avatar(path, size=128):
+    """
+    Returns the avatar image at `path` resized to fit `size` pixels and 
+    encoded as PNG. The image is only decoded once per process for each 
+    path and modification time, and is shared by all containers.
+    """
+    from PIL import Image
+    if not isinstance(path, (str, os.PathLike)):
+        return Image.open(path)
+    def load():
+        image = Image.open(path)
+        image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+    key = (os.path.abspath(path), os.stat(path).st_mtime, size)
+    return avatar_cache.get_or_set(key, load)
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def enforce_memory_budget(max_bytes):
+    """
+    Spill the binary blocks (e.g. images) of the session's containers to disk, 
+    oldest first, until the blocks held in memory take up at most 
+    `max_bytes`. Spilled blocks are loaded again when they are rendered.
+    """
+    blocks = [x for container in st.session_state.containers for x in container.blocks if x.type == 'image' and x.loaded]
+    size = sum(len(x) for x in blocks)
+    if size <= max_bytes:
+        return
+    if "spill_session" not in st.session_state:
+        st.session_state.spill_session = SpoolSession(os.path.join(tempfile.gettempdir(), "canu-spill"))
+    for block in blocks:
+        if size <= max_bytes:
+            break
+        content = block.content
+        path = os.path.join(st.session_state.spill_session.path, hashlib.sha256(content).hexdigest())
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(content)
+        block.unload(functools.partial(read_file, path))
+        size -= len(block)
+
+def write_containers():
+    """
+    Write the session's containers. Only the most recent turns are rendered; 
+    older ones are shown on demand with the 'Show earlier' button. Afterwards, 
+    older binary content is spilled to disk to keep the session within its 
+    memory budget. These are set with the `memory.recent_turns` (default 20) 
+    and `memory.max_bytes` (default 64 MB) options in the config.yaml file.
+    """
+    labels = {
+        'Show earlier': {'English': 'Show earlier messages', 'Korean': '이전 메시지 보기', 'Spanish': 'Mostrar mensajes anteriores', 'Japanese': '以前のメッセージを表示'},
+    }
+    config = {}
+    if "config" in st.session_state:
+        config = st.session_state.config.get('memory', {})
+    recent_turns = config.get('recent_turns', 20)
+    if "visible_turns" not in st.session_state:
+        st.session_state.visible_turns = recent_turns
+    containers = st.session_state.containers
+    if len(containers) > st.session_state.visible_turns:
+        if st.button(labels['Show earlier'][st.session_state.language]):
+            st.session_state.visible_turns += recent_turns
+            st.rerun()
+        containers = containers[len(containers) - st.session_state.visible_turns:]
+    for container in containers:
+        container.write_blocks()
+    enforce_memory_budget(config.get('max_bytes', 64 * 1024 * 1024))
+
 def show_login_page():
     labels = {
         'Form name': {'English': 'Login', 'Korean': '로그인', 'Spanish': 'Inicio de sesión', 'Japanese': 'ログイン'},
@@ -227,38 +810,31 @@ def show_profile_page():
     Show the profile page.
     """
     def update_yaml():
-        with open("./auth.yaml", 'w', encoding="utf-8-sig") as f:
-            data = {
-                'cookie': {
-                    'cookie_name': st.session_state.authenticator.cookie_handler.cookie_name,
-                    'cookie_key': st.session_state.authenticator.cookie_handler.cookie_key,
-                    'cookie_expiry_days': st.session_state.authenticator.cookie_handler.cookie_expiry_days,
-                },
-                'credentials': st.session_state.authenticator.authentication_handler.credentials
-            }
-            
-            yaml.dump(data, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        credentials = st.session_state.authenticator.authentication_handler.credentials
+        password = credentials['usernames'][st.session_state.username]['password']
+        # Only change this user's password so that concurrent changes by 
+        # other users are not overwritten.
+        with yaml_lock:
+            data = copy.deepcopy(load_yaml("./auth.yaml"))
+            data['credentials']['usernames'][st.session_state.username]['password'] = password
+            write_yaml("./auth.yaml", data)
 
     def update_mysql():
+        import mysql.connector
         credentials = st.session_state.authenticator.authentication_handler.credentials
         password = credentials['usernames'][st.session_state.username]['password']
         try:
-            connection = mysql.connector.connect(
-                user=st.session_state.config['authentication']['user'],
-                password=st.session_state.config['authentication']['password'],
-                host=st.session_state.config['authentication']['host'],
-                database=st.session_state.config['authentication']['database']
-            )
-            if connection.is_connected():
+            connection = get_mysql_connection()
+            try:
                 cursor = connection.cursor()
                 cursor.execute(f"UPDATE {st.session_state.config['authentication']['table']} SET password = %s WHERE username = %s", (password, st.session_state.username))
                 connection.commit()
                 cursor.close()
+            finally:
+                connection.close()
         except mysql.connector.Error as e:
             st.error(f"Error connecting to MySQL database: {e}")
-        finally:
-            if connection.is_connected():
-                connection.close()
+        mysql_user_cache.pop(st.session_state.username)
 
     labels = {
         'Form name': {'English': 'Reset password', 'Korean': '비밀번호 변경', 'Spanish': 'Restablecer contraseña', 'Japanese': 'パスワードをリセットする'},
@@ -297,104 +873,12 @@ def get_uploaded_files():
 def show_history_page():
     """
     Manage the conversation history based on the storage method specified in 
-    the config.yaml file. Currently, the supported methods are 'LOCAL' and 
-    'S3'.
-    """
-    def from_local():
-        if not os.path.isdir("./users"):
-            os.mkdir("./users")
-        if not os.path.isdir(f"./users/{st.session_state.username}"):
-            os.mkdir(f"./users/{st.session_state.username}")
-        st.header(labels['Current conversation'][st.session_state.language])
-        with st.form(labels['Save conversation'][st.session_state.language], clear_on_submit=True):
-            file_name = st.text_input(labels['Conversation name'][st.session_state.language])
-            submitted = st.form_submit_button(labels['Save'][st.session_state.language])
-            if submitted:
-                data = []
-                for container in st.session_state.containers:
-                    data.append([container.role, container.blocks])
-                with open(f"./users/{st.session_state.username}/{file_name}.pkl", 'wb') as f:
-                    pickle.dump(data, f)
-        st.header(labels['Past conversations'][st.session_state.language])
-        files = os.listdir(f"./users/{st.session_state.username}")
-        files = [x for x in files if x.endswith('.pkl')]
-        options = [x.replace('.pkl', '') for x in files]
-        option = st.selectbox(labels['Select conversation'][st.session_state.language], options)
-        col1, col2 = st.columns((1, 6))
-        with col1:
-            if option is not None and st.button(labels['Load'][st.session_state.language]):
-                delete_messages()
-                st.session_state.containers = []
-                with open(f"./users/{st.session_state.username}/{option}.pkl", 'rb') as f:
-                    data = pickle.load(f)
-                    for x in data:
-                        role = x[0]
-                        blocks = x[1]
-                        container = Container(role, blocks)
-                        st.session_state.containers.append(container)
-                        create_message(role, container.get_content())
-                st.session_state.page = "chatbot"
-                st.rerun()
-        with col2:
-            if option is not None and st.button(labels['Delete'][st.session_state.language]):
-                os.remove(f"./users/{st.session_state.username}/{option}.pkl")
-                st.rerun()
-
-    def from_s3():
-        bucket = st.session_state.config['history']['bucket']
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=st.session_state.config['history']['aws_access_key_id'],
-            aws_secret_access_key=st.session_state.config['history']['aws_secret_access_key']
-        )
-        s3_folder = f"{st.session_state.config['history']['users_dir']}/{st.session_state.username}"
-        st.header(labels['Current conversation'][st.session_state.language])
-        with st.form(labels['Save conversation'][st.session_state.language], clear_on_submit=True):
-            file_name = st.text_input(labels['Conversation name'][st.session_state.language])
-            submitted = st.form_submit_button(labels['Save'][st.session_state.language])
-            if submitted:
-                data = []
-                for container in st.session_state.containers:
-                    data.append([container.role, container.blocks])
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file_name = temp_file.name
-                    with open(temp_file_name, 'wb') as f:
-                        pickle.dump(data, f)
-                    s3.upload_file(temp_file_name, bucket, f"{s3_folder}/{file_name}.pkl")
-                    os.remove(temp_file_name)
-
-        st.header(labels['Past conversations'][st.session_state.language])
-        file_list = []
-        folder_exists = s3.list_objects(Bucket=bucket, Prefix=f"{s3_folder}/")
-        if 'Contents' in folder_exists:
-            for obj in folder_exists['Contents']:
-                file_list.append(os.path.basename(obj['Key']))
-        files = [x for x in file_list if x.endswith('.pkl')]
-        options = [x.replace('.pkl', '') for x in files]
-        option = st.selectbox(labels['Select conversation'][st.session_state.language], options)
-        col1, col2 = st.columns((1, 6))
-        with col1:
-            if option is not None and st.button(labels['Load'][st.session_state.language]):
-                delete_messages()
-                st.session_state.containers = []
-                with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-                    temp_file_name = temp_file.name
-                    s3.download_file(bucket, f"{s3_folder}/{option}.pkl", temp_file_name)
-                    with open(temp_file_name, 'rb') as f:
-                        data = pickle.load(f)
-                        for x in data:
-                            role = x[0]
-                            blocks = x[1]
-                            container = Container(role, blocks)
-                            st.session_state.containers.append(container)
-                            create_message(role, container.get_content())
-                st.session_state.page = "chatbot"
-                st.rerun()
-        with col2:
-            if option is not None and st.button(labels['Delete'][st.session_state.language]):
-                s3.delete_object(Bucket=bucket, Key=f"{s3_folder}/{option}.pkl")
-                st.rerun()
-
+    the config.yaml file. Currently, the supported methods are 'LOCAL', 'S3' 
+    and 'SQLITE'. Conversations are saved as a message index with images kept in a 
+    content-addressed blob store, which are only loaded when rendered. Past 
+    conversations can be searched by their text, and only the selected one 
+    is loaded.
+    """
     labels = {
         'Go back': {'English': 'Go back', 'Korean': '돌아가기', 'Spanish': 'Regresar', 'Japanese': '戻る'},
         'Current conversation': {'English': 'Current conversation', 'Korean': '현재 대화', 'Spanish': 'Conversación actual', 'Japanese': '現在の会話'},
@@ -402,6 +886,8 @@ def show_history_page():
         'Conversation name': {'English': 'Enter a name for the conversation to save.', 'Korean': '저장할 대화 이름을 입력하세요.', 'Spanish': 'Ingrese un nombre para la conversación a guardar.', 'Japanese': '保存する会話の名前を入力してください。'},
         'Save': {'English': 'Save', 'Korean': '저장', 'Spanish': 'Guardar', 'Japanese': '保存'},
         'Past conversations': {'English': 'Past conversations', 'Korean': '과거 대화', 'Spanish': 'Conversaciones pasadas', 'Japanese': '過去の会話'},
+        'Search conversations': {'English': 'Search past conversations.', 'Korean': '과거 대화를 검색하세요.', 'Spanish': 'Busque en las conversaciones pasadas.', 'Japanese': '過去の会話を検索してください。'},
+        'No results': {'English': 'No matching conversations.', 'Korean': '일치하는 대화가 없습니다.', 'Spanish': 'No hay conversaciones que coincidan.', 'Japanese': '一致する会話がありません。'},
         'Select conversation': {'English': 'Select a conversation.', 'Korean': '대화를 선택해주세요.', 'Spanish': 'Seleccione una conversación.', 'Japanese': '会話を選択してください。'},
         'Load': {'English': 'Load', 'Korean': '불러오기', 'Spanish': 'Cargar', 'Japanese': 'ロード'},
         'Delete': {'English': 'Delete', 'Korean': '삭제하기', 'Spanish': 'Eliminar', 'Japanese': '削除'},
@@ -411,91 +897,170 @@ def show_history_page():
     if st.sidebar.button(labels['Go back'][st.session_state.language]):
         st.session_state.page = "chatbot"
         st.rerun()
-    if st.session_state.config['history']['method'] == "LOCAL":
-        from_local()
-    elif st.session_state.config['history']['method'] == "S3":
-        from_s3()
+    store = history.get_store(st.session_state.config)
+    username = st.session_state.username
+    st.header(labels['Current conversation'][st.session_state.language])
+    with st.form(labels['Save conversation'][st.session_state.language], clear_on_submit=True):
+        file_name = st.text_input(labels['Conversation name'][st.session_state.language])
+        submitted = st.form_submit_button(labels['Save'][st.session_state.language])
+        if submitted:
+            data = []
+            for container in st.session_state.containers:
+                data.append([container.role, [x.to_dict() for x in container.blocks]])
+            history.save_conversation(store, username, file_name, data)
+    st.header(labels['Past conversations'][st.session_state.language])
+    query = st.text_input(labels['Search conversations'][st.session_state.language])
+    if query:
+        results = history.search_conversations(store, username, query)
+        if not results:
+            st.info(labels['No results'][st.session_state.language])
+        for result in results:
+            st.markdown(f"**{result['name']}** · {result['role']} #{result['turn'] + 1}")
+            st.caption(result['snippet'])
+        options = list(dict.fromkeys(x['name'] for x in results))
     else:
-        raise ValueError(f"Invalid history storage method: {st.session_state.config['history']['method']}")
+        options = history.list_conversations(store, username)
+    option = st.selectbox(labels['Select conversation'][st.session_state.language], options)
+    col1, col2 = st.columns((1, 6))
+    with col1:
+        if option is not None and st.button(labels['Load'][st.session_state.language]):
+            get_blob = lambda digest: history.get_blob(store, username, digest)
+            st.session_state.containers = []
+            for role, blocks in history.load_conversation(store, username, option):
+                blocks = [Block.from_dict(x, get_blob) for x in blocks]
+                st.session_state.containers.append(Container(role, blocks))
+            restore_messages(st.session_state.containers)
+            st.session_state.page = "chatbot"
+            st.rerun()
+    with col2:
+        if option is not None and st.button(labels['Delete'][st.session_state.language]):
+            def detach(digests):
+                for container in st.session_state.containers:
+                    for block in container.blocks:
+                        if block.digest in digests:
+                            block.detach()
+            history.delete_conversation(store, username, option, detach=detach)
+            st.rerun()
 
-def handle_files():
+def handle_files(max_workers=4):
+    """
+    Upload new files from the sidebar to OpenAI and delete removed ones. New 
+    files are converted and uploaded by up to `max_workers` threads.
+    """
     labels = {
         'Unsupported file type': {'English': 'Unsupported file type', 'Korean': '지원하지 않는 파일 형식', 'Spanish': 'Tipo de archivo no compatible', 'Japanese': 'サポートされていないファイル形式'},
         'Upload file': {'English': 'File Upload', 'Korean': '파일 업로드', 'Spanish': 'Subir archivo', 'Japanese': 'ファイルアップロード'},
         'Delete file': {'English': 'Delete file', 'Korean': '파일 삭제', 'Spanish': 'Eliminar archivo', 'Japanese': 'ファイル削除'},
+        'Upload failed': {'English': 'File upload failed', 'Korean': '파일 업로드 실패', 'Spanish': 'Error al subir el archivo', 'Japanese': 'ファイルアップロード失敗'},
     }
     supported_files = {
         "file_search": ['.c', '.cs', '.cpp', '.doc', '.docx', '.html', '.java', '.json', '.md', '.pdf', '.php', '.pptx', '.py', '.rb', '.texv', '.txt', '.css', '.js', '.sh', '.ts'],
         "code_interpreter": ['.c', '.cs', '.cpp', '.doc', '.docx', '.html', '.java', '.json', '.md', '.pdf', '.php', '.pptx', '.py', '.rb', '.tex', '.txt', '.css', '.js', '.sh', '.ts', '.csv', '.jpeg', '.jpg', '.gif', '.png', '.tar', '.xlsx', '.xml', '.zip']
     }
 
-    uploaded_files = get_uploaded_files()
+    client = st.session_state.client
 
-    for uploaded_file in uploaded_files:
-        upload_id = uploaded_file.file_id
-        file_name = uploaded_file.name
-        if upload_id in st.session_state.upload_ids:
-            continue
-        _, file_extension = os.path.splitext(file_name)
-        if file_extension not in supported_files["file_search"] and file_extension not in supported_files["code_interpreter"] and file_extension not in [".hwp", ".xls"]: 
-            add_message("user", f"{labels['Unsupported file type'][st.session_state.language]}: `{file_name}`")
-            print(f"Unsupported file type: {file_name}")
-            st.session_state.file_uploader_key += 1
-            st.rerun()
+    def ingest(file_name, data):
+        """
+        Convert a file if necessary and upload it to OpenAI. Runs in a worker 
+        thread, so it must not touch the session state.
+        """
         with tempfile.TemporaryDirectory() as t:
             file_path = os.path.join(t, file_name)
 
             with open(file_path, "wb") as f:
-                f.write(uploaded_file.getvalue())
-            add_message("user", f"{labels['Upload file'][st.session_state.language]}: `{file_name}`")
-
-            # Convert .xls to .xlsx.
-            if file_name.endswith(".xls"):
-                wb1 = xlrd.open_workbook(file_path)
-                wb2 = openpyxl.Workbook()
-                for sheet_name in wb1.sheet_names():
-                    sheet1 = wb1.sheet_by_name(sheet_name)
-                    sheet2 = wb2.create_sheet(title=sheet_name)
-                    for row in range(sheet1.nrows):
-                        for col in range(sheet1.ncols):
-                            sheet2.cell(row=row+1, column=col+1, value=sheet1.cell_value(row, col))
-                wb2.remove(wb2['Sheet'])
-                file_name = file_name.replace(".xls", ".xlsx")
-                file_path = file_path.replace(".xls", ".xlsx")
-                wb2.save(file_path)
-            # Convert .hwp to .html.
-            elif file_name.endswith(".hwp"):
-                with open(file_path, 'rb') as f1:
-                    file_name = file_name.replace(".hwp", ".html")
-                    file_path = file_path.replace(".hwp", ".html")
-                    os.system(f"""hwp5html "{file_path.replace('.html', '.hwp')}" --output "{file_path}" --html""")
+                f.write(data)
+
+            # Convert files such as .xls and .hwp to a supported format.
+            if converters.service.supports(file_name):
+                file_path = converters.service.convert(file_path)
+                file_name = os.path.basename(file_path)
 
             if file_name.endswith(".jpg") or file_name.endswith(".png") or file_name.endswith(".jpeg"):
-                file = st.session_state.client.files.create(file=Path(file_path), purpose="vision")
-                content=[
-                    {"type": "text", "text": f"{labels['Upload file'][st.session_state.language]}: `{file_name}`"},
-                    {"type": "image_file", "image_file": {"file_id": file.id}}
-                ]
-                create_message("user", content)
+                purpose = "vision"
             else:
-                file = st.session_state.client.files.create(file=Path(file_path), purpose="assistants")
-                tools = []
-                if file_name.endswith(tuple(supported_files["file_search"])):
-                    tools.append({"type": "file_search"})
-                if file_name.endswith(tuple(supported_files["code_interpreter"])):
-                    tools.append({"type": "code_interpreter"})
-                if not tools:
-                    tools.append({"type": "code_interpreter"})
-                attachments = [{"file_id": file.id, "tools": tools}]
-                content=[{"type": "text", "text": f"{labels['Upload file'][st.session_state.language]}: `{file_name}`"}]
-                create_message("user", content, attachments)
-            st.session_state.upload_ids[upload_id] = {'file_id': file.id, 'file_name': file_name}
+                purpose = "assistants"
+            file_id = upload_file(file_path, purpose, client=client)
+        return file_name, file_id, purpose
+
+    uploaded_files = get_uploaded_files()
+
+    # Files that failed to upload stay in the uploader but are not retried 
+    # until they are removed and added again.
+    failed_upload_ids = st.session_state.setdefault("failed_upload_ids", set())
+    failed_upload_ids &= {x.file_id for x in uploaded_files}
+
+    new_files = []
+    for uploaded_file in uploaded_files:
+        if uploaded_file.file_id in st.session_state.upload_ids or uploaded_file.file_id in failed_upload_ids:
+            continue
+        _, file_extension = os.path.splitext(uploaded_file.name)
+        if file_extension not in supported_files["file_search"] and file_extension not in supported_files["code_interpreter"] and not converters.service.supports(uploaded_file.name):
+            add_message("user", f"{labels['Unsupported file type'][st.session_state.language]}: `{uploaded_file.name}`")
+            print(f"Unsupported file type: {uploaded_file.name}")
+            st.session_state.file_uploader_key += 1
+            st.rerun()
+        new_files.append(uploaded_file)
 
+    # Convert and upload the new files concurrently, then post their 
+    # messages in the order in which they were uploaded. Files that fail 
+    # are reported once and otherwise left alone.
+    if new_files:
+        results = {}
+        failed = []
+        progress = st.sidebar.progress(0.0)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(ingest, x.name, x.getvalue()): x for x in new_files}
+            for future in as_completed(futures):
+                uploaded_file = futures[future]
+                try:
+                    results[uploaded_file.file_id] = future.result()
+                except Exception as e:
+                    print(f"Could not upload file {uploaded_file.name}: {e!r}")
+                    failed.append(uploaded_file)
+                done = len(results) + len(failed)
+                progress.progress(done / len(new_files), text=f"{labels['Upload file'][st.session_state.language]}: `{uploaded_file.name}` ({done}/{len(new_files)})")
+        progress.empty()
+        try:
+            for uploaded_file in new_files:
+                if uploaded_file.file_id not in results:
+                    continue
+                file_name, file_id, purpose = results[uploaded_file.file_id]
+                add_message("user", f"{labels['Upload file'][st.session_state.language]}: `{uploaded_file.name}`")
+                if purpose == "vision":
+                    content=[
+                        {"type": "text", "text": f"{labels['Upload file'][st.session_state.language]}: `{file_name}`"},
+                        {"type": "image_file", "image_file": {"file_id": file_id}}
+                    ]
+                    create_message("user", content)
+                else:
+                    tools = []
+                    if file_name.endswith(tuple(supported_files["file_search"])):
+                        tools.append({"type": "file_search"})
+                    if file_name.endswith(tuple(supported_files["code_interpreter"])):
+                        tools.append({"type": "code_interpreter"})
+                    if not tools:
+                        tools.append({"type": "code_interpreter"})
+                    attachments = [{"file_id": file_id, "tools": tools}]
+                    content=[{"type": "text", "text": f"{labels['Upload file'][st.session_state.language]}: `{file_name}`"}]
+                    create_message("user", content, attachments)
+                st.session_state.upload_ids[uploaded_file.file_id] = {'file_id': file_id, 'file_name': file_name}
+                del results[uploaded_file.file_id]
+        finally:
+            # Release uploads that were never recorded, e.g. because posting 
+            # their message failed.
+            for _, file_id, _ in results.values():
+                delete_file(file_id, client=client)
+        for uploaded_file in failed:
+            add_message("user", f"{labels['Upload failed'][st.session_state.language]}: `{uploaded_file.name}`")
+            failed_upload_ids.add(uploaded_file.file_id)
+
+    upload_ids = {x.file_id for x in uploaded_files}
     for upload_id, upload_data in list(st.session_state.upload_ids.items()):
         file_name = upload_data["file_name"]
         file_id = upload_data["file_id"]
-        if upload_id not in [x.file_id for x in uploaded_files]:
-            st.session_state.client.files.delete(file_id)
+        if upload_id not in upload_ids:
+            delete_file(file_id)
             add_message("user", f"{labels['Delete file'][st.session_state.language]}: `{file_name}`")
             del st.session_state.upload_ids[upload_id]
 
@@ -505,53 +1070,267 @@ def list_messages():
     )
     return messages
 
-def delete_messages():
-    messages = list_messages()
-    for message in messages.data:
-        deleted_message = st.session_state.client.beta.threads.messages.delete(
-            thread_id=st.session_state.thread.id,
-            message_id=message.id
+def delete_messages(max_workers=8):
+    """
+    Delete all messages in the thread, using up to `max_workers` concurrent 
+    requests.
+    """
+    client = st.session_state.client
+    thread_id = st.session_state.thread.id
+    def delete(message):
+        client.beta.threads.messages.delete(thread_id=thread_id, message_id=message.id)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(delete, list_messages()))
+
+def restore_messages(containers, max_workers=8, batch_size=32):
+    """
+    Replace the thread's messages with those of the given containers. A new 
+    thread is created with the old thread's tool resources (e.g. the vector 
+    store of uploaded files) and pre-seeded with the first `batch_size` 
+    messages, which is the most the API accepts in one request. The rest are 
+    appended in order and the old thread is discarded. If the thread cannot 
+    be seeded, the old messages are deleted concurrently and the new ones 
+    are created one by one, since their order matters.
+    """
+    client = st.session_state.client
+    old_thread = st.session_state.thread
+    messages = []
+    for container in containers:
+        content = container.get_content()
+        if content:
+            messages.append({"role": container.role, "content": content})
+    try:
+        tool_resources = client.beta.threads.retrieve(old_thread.id).tool_resources
+        thread = client.beta.threads.create(
+            messages=messages[:batch_size],
+            tool_resources=tool_resources.model_dump(exclude_none=True) if tool_resources else openai.NOT_GIVEN
         )
+    except openai.BadRequestError:
+        delete_messages(max_workers=max_workers)
+        for message in messages:
+            create_message(message["role"], message["content"])
+        return
+    st.session_state.thread = thread
+    for message in messages[batch_size:]:
+        create_message(message["role"], message["content"])
+    try:
+        client.beta.threads.delete(old_thread.id)
+    except openai.APIError as e:
+        print(f"Could not delete thread {old_thread.id}: {e}")
 
 def create_message(role, content, attachments=None):
     """
     Create a message and add it to the thread.
     """
     if not is_thread_locked():
-        st.session_state.client.beta.threads.messages.create(
-            thread_id=st.session_state.thread.id,
-            role=role,
-            content=content,
-            attachments=attachments
-        )
+        with metrics.timer("messages.create"):
+            st.session_state.client.beta.threads.messages.create(
+                thread_id=st.session_state.thread.id,
+                role=role,
+                content=content,
+                attachments=attachments
+            )
 
 def delete_files():
     """
     Delete all files uploaded to OpenAI.
     """
     for upload_id, upload_data in st.session_state.upload_ids.items():
-        st.session_state.client.files.delete(upload_data["file_id"])
+        delete_file(upload_data["file_id"])
+
+def spool_file(file_id, client=None, prefetch=True):
+    """
+    Download a file into the session's spool directory without holding it 
+    in memory and return it as a `SpooledFile`. The directory is removed 
+    when the session ends. If `prefetch` is False, the file is downloaded 
+    when it is first read.
+    """
+    if client is None:
+        client = st.session_state.client
+    if "spool_session" not in st.session_state:
+        st.session_state.spool_session = spool.create_session()
+    @metrics.timed("files.content")
+    def fetch(file_id, path):
+        with client.files.with_streaming_response.content(file_id) as response:
+            spool.write(path, response.iter_bytes())
+    file = SpooledFile(os.path.join(st.session_state.spool_session.path, file_id), file_id, fetch)
+    if prefetch and not os.path.exists(file.path):
+        fetch(file_id, file.path)
+    return file
+
+async def spool_file_async(file_id, client):
+    """
+    Like `canu.spool_file`, but downloads the file with an 
+    `openai.AsyncOpenAI` client. If the file is evicted from the spool, it 
+    is downloaded again with `st.session_state.client`.
+    """
+    file = spool_file(file_id, prefetch=False)
+    if not os.path.exists(file.path):
+        with metrics.timer("files.content"):
+            async with client.files.with_streaming_response.content(file_id) as response:
+                await spool.write_async(file.path, response.iter_bytes())
+    return file
+
+def upload_file(file_path, purpose, client=None):
+    """
+    Upload a file to OpenAI and return its id. If a file with the same 
+    content and purpose is already uploaded, it is reused instead.
+    """
+    if client is None:
+        client = st.session_state.client
+    @metrics.timed("files.retrieve")
+    def retrieve(file_id):
+        return client.files.retrieve(file_id)
+    def validate(file_id):
+        try:
+            file_cache.get_or_set(file_id, lambda: retrieve(file_id))
+        except openai.NotFoundError:
+            return False
+        return True
+    @metrics.timed("files.create")
+    def upload(file_path, purpose):
+        return client.files.create(file=Path(file_path), purpose=purpose).id
+    return upload_index.acquire(
+        file_path,
+        purpose,
+        upload=upload,
+        delete=metrics.timed("files.delete")(client.files.delete),
+        validate=validate
+    )
+
+def delete_file(file_id, client=None):
+    """
+    Release a file uploaded with `canu.upload_file`. It is deleted from 
+    OpenAI once no other upload refers to it.
+    """
+    if client is None:
+        client = st.session_state.client
+    if upload_index.release(file_id, metrics.timed("files.delete")(client.files.delete)):
+        file_cache.pop(file_id)
+        file_content_cache.pop(file_id)
+
+def retrieve_file(file_id):
+    """
+    Returns the metadata of a file, using the process-wide cache.
+    """
+    client = st.session_state.client
+    return file_cache.get_or_set(
+        file_id, metrics.timed("files.retrieve")(lambda: client.files.retrieve(file_id))
+    )
+
+def get_file_content(file_id):
+    """
+    Returns the content of a file as bytes, using the process-wide cache.
+    """
+    client = st.session_state.client
+    return file_content_cache.get_or_set(
+        file_id, metrics.timed("files.content")(lambda: client.files.content(file_id).read())
+    )
+
+async def retrieve_file_async(file_id, client):
+    """
+    Like `canu.retrieve_file`, but with an `openai.AsyncOpenAI` client.
+    """
+    file = file_cache.get(file_id)
+    if file is None:
+        with metrics.timer("files.retrieve"):
+            file = await client.files.retrieve(file_id)
+        file_cache.set(file_id, file)
+    return file
+
+async def get_file_content_async(file_id, client):
+    """
+    Like `canu.get_file_content`, but with an `openai.AsyncOpenAI` client.
+    """
+    content = file_content_cache.get(file_id)
+    if content is None:
+        with metrics.timer("files.content"):
+            content = (await client.files.content(file_id)).read()
+        file_content_cache.set(file_id, content)
+    return content
 
 def list_runs(limit=100):
     """
     Returns a list of runs belonging to the thread.
     """
-    runs = st.session_state.client.beta.threads.runs.list(
-        thread_id=st.session_state.thread.id,
-        limit=limit
-    )
+    with metrics.timer("runs.list"):
+        runs = st.session_state.client.beta.threads.runs.list(
+            thread_id=st.session_state.thread.id,
+            limit=limit
+        )
     return runs
 
+def set_run_state(run):
+    """
+    Record the latest known state of a run belonging to the thread.
+    """
+    st.session_state.run_state = {'thread_id': run.thread_id, 'run_id': run.id, 'status': run.status}
+
 def is_thread_locked():
     """
-    Returns whether the thread is locked.
+    Returns whether the thread is locked. The state of the thread's latest 
+    run is tracked locally from stream events, so the API is only queried 
+    when that state is unknown or the run has not finished yet.
+    """
+    state = st.session_state.run_state if "run_state" in st.session_state else None
+    if state is None or state['thread_id'] != st.session_state.thread.id:
+        runs = list_runs(limit=1).data
+        if not runs:
+            st.session_state.run_state = {'thread_id': st.session_state.thread.id, 'run_id': None, 'status': None}
+            return False
+        set_run_state(runs[0])
+    elif state['status'] in ["queued", "in_progress", "requires_action", "cancelling"]:
+        with metrics.timer("runs.retrieve"):
+            run = st.session_state.client.beta.threads.runs.retrieve(
+                thread_id=state['thread_id'],
+                run_id=state['run_id']
+            )
+        set_run_state(run)
+    return st.session_state.run_state['status'] in ["queued", "in_progress"]
+
+def load_yaml(path):
+    """
+    Returns the parsed YAML file. The result is shared by all sessions in 
+    the process and the file is only parsed again when its modification 
+    time changes. Callers must not modify the result.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with yaml_lock:
+        if path in yaml_cache and yaml_cache[path][0] == mtime:
+            return yaml_cache[path][1]
+        with open(path, encoding="utf-8-sig") as f:
+            data = yaml.load(f, Loader=yaml.loader.SafeLoader)
+        yaml_cache[path] = (mtime, data)
+        return data
+
+def write_yaml(path, data):
     """
-    return len([x for x in list_runs().data if x.status in ["queued", "in_progress"]]) > 0
+    Atomically replace the YAML file and update the shared cache.
+    """
+    path = os.path.abspath(path)
+    with yaml_lock:
+        with tempfile.NamedTemporaryFile('w', encoding="utf-8-sig", dir=os.path.dirname(path), delete=False) as f:
+            yaml.dump(data, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        if os.path.exists(path):
+            os.chmod(f.name, os.stat(path).st_mode)
+        os.replace(f.name, path)
+        yaml_cache[path] = (os.stat(path).st_mtime_ns, data)
+
+def invalidate_yaml(path=None):
+    """
+    Drop the shared copy of a YAML file, or of all files if `path` is None, 
+    so that it is parsed again on next use.
+    """
+    with yaml_lock:
+        if path is None:
+            yaml_cache.clear()
+        else:
+            yaml_cache.pop(os.path.abspath(path), None)
 
 def get_config():
     """
-    Get the configuration from the config.yaml file.
+    Get the configuration from the config.yaml file. The file is parsed once 
+    per process and reloaded when it changes.
     """
-    if "config" not in st.session_state:
-        with open("./config.yaml") as f:
-            st.session_state.config = yaml.load(f, Loader=yaml.loader.SafeLoader)
+    st.session_state.config = load_yaml("./config.yaml")
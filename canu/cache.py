@@ -0,0 +1,188 @@
+import os, sys, time, pickle, hashlib, threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+def _sizeof(value):
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+class LRUCache():
+    """
+    A thread-safe least-recently-used cache bounded by the number of entries
+    and, optionally, by their total size in bytes. Entries expire after
+    `ttl` seconds if it is given.
+    """
+    def __init__(self, max_entries=256, max_bytes=None, ttl=None, sizeof=_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes is not None and self._size > self.max_bytes)
+        ):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self._size -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[2] is not None and entry[2] < time.monotonic():
+                del self._data[key]
+                self._size -= entry[1]
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            self._data[key] = (value, size, expires)
+            self._size += size
+            self._evict()
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value for `key`, calling `func()` and caching its
+        result on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            self._size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters along with the current size.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._data), 'bytes': self._size}
+
+class DiskCache():
+    """
+    A cache stored as one pickle file per entry under `path`, so it survives
+    restarts and can be shared between processes. Entries expire after `ttl`
+    seconds if it is given, and the least recently used entries are removed
+    once there are more than `max_entries`.
+    """
+    def __init__(self, path, max_entries=1024, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha256(repr(key).encode("utf-8")).hexdigest())
+
+    def get(self, key, default=None):
+        file = self._file(key)
+        try:
+            with open(file, 'rb') as f:
+                expires, value = pickle.load(f)
+            if expires is not None and expires < time.time():
+                os.remove(file)
+                raise FileNotFoundError(file)
+            os.utime(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def _entries(self):
+        return [os.path.join(self.path, x) for x in os.listdir(self.path) if not x.endswith('.tmp')]
+
+    def set(self, key, value):
+        file = self._file(key)
+        tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump((None if self.ttl is None else time.time() + self.ttl, value), f)
+        os.replace(tmp, file)
+        # Other processes may add or remove entries at the same time, so 
+        # files can disappear at any point.
+        with self._lock:
+            files = []
+            for x in self._entries():
+                try:
+                    files.append((os.stat(x).st_mtime, x))
+                except FileNotFoundError:
+                    continue
+            if len(files) > self.max_entries:
+                for _, x in sorted(files)[:len(files) - self.max_entries]:
+                    try:
+                        os.remove(x)
+                    except FileNotFoundError:
+                        pass
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value for `key`, calling `func()` and caching its
+        result on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def clear(self):
+        """
+        Remove all entries. Files still being written by other writers are 
+        left alone.
+        """
+        for x in self._entries():
+            try:
+                os.remove(x)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns the hit and miss counters along with the current size.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries())}
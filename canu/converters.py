@@ -0,0 +1,169 @@
+import os, sys, shutil, hashlib, tempfile, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def _convert_row(types, values, datemode):
+    import xlrd
+    for i, ctype in enumerate(types):
+        if ctype == xlrd.XL_CELL_DATE:
+            try:
+                values[i] = xlrd.xldate.xldate_as_datetime(values[i], datemode)
+            except xlrd.xldate.XLDateError:
+                pass
+        elif ctype == xlrd.XL_CELL_BOOLEAN:
+            values[i] = bool(values[i])
+        elif ctype in [xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK]:
+            values[i] = None
+        elif ctype == xlrd.XL_CELL_ERROR:
+            values[i] = xlrd.error_text_from_code.get(values[i])
+    return values
+
+def xls_to_xlsx(src, dst):
+    """
+    Convert an .xls file to .xlsx. Sheets are loaded one at a time and rows
+    are streamed to a write-only workbook, so memory use stays bounded by the
+    largest sheet. Dates, numbers and booleans keep their types.
+    """
+    import xlrd
+    import openpyxl
+    wb1 = xlrd.open_workbook(src, on_demand=True)
+    wb2 = openpyxl.Workbook(write_only=True)
+    try:
+        for sheet_name in wb1.sheet_names():
+            sheet1 = wb1.sheet_by_name(sheet_name)
+            sheet2 = wb2.create_sheet(title=sheet_name)
+            for row in range(sheet1.nrows):
+                sheet2.append(_convert_row(sheet1.row_types(row), sheet1.row_values(row), wb1.datemode))
+            wb1.unload_sheet(sheet_name)
+        wb2.save(dst)
+    finally:
+        wb1.release_resources()
+    return dst
+
+def convert_xls_files(paths, max_workers=None):
+    """
+    Convert several .xls files to .xlsx at once, each in its own process 
+    (see `xls_to_xlsx_in_process`). Each output is written next to its 
+    input. Returns the output paths.
+    """
+    dsts = [f"{x[:-len('.xls')]}.xlsx" for x in paths]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        return list(executor.map(xls_to_xlsx_in_process, paths, dsts))
+
+def hwp_to_html(src, dst, timeout=None):
+    """
+    Convert an .hwp file to .html with hwp5html. The process is killed if it 
+    runs longer than `timeout` seconds.
+    """
+    subprocess.run(
+        ["hwp5html", src, "--output", dst, "--html"],
+        check=True,
+        timeout=timeout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    return dst
+
+def xls_to_xlsx_in_process(src, dst, timeout=None):
+    """
+    Run `xls_to_xlsx` in a separate Python process, which is killed if it 
+    runs longer than `timeout` seconds. The converter module is run as a 
+    script rather than through `multiprocessing`, whose spawned workers 
+    import the parent's `__main__`; under Streamlit that is the app script.
+    """
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), src, dst],
+        check=True,
+        timeout=timeout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    return dst
+
+class ConverterService():
+    """
+    Convert uploaded files to formats supported by OpenAI. Converters are 
+    registered by file extension and called as `func(src, dst, timeout)`. At 
+    most `max_concurrency` conversions run at once, and results are cached 
+    in `cache_dir` by the SHA-256 of the input, so identical documents are 
+    only converted once. The cache is pruned to `max_cache_bytes`, oldest 
+    first.
+    """
+    def __init__(self, cache_dir="./.canu/conversions", max_concurrency=2, timeout=120, max_cache_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_cache_bytes = max_cache_bytes
+        self.converters = {}
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, extension, target_extension, func):
+        self.converters[extension] = (target_extension, func)
+
+    def supports(self, file_name):
+        return os.path.splitext(file_name)[1] in self.converters
+
+    def _prune(self):
+        # Other threads and processes may be writing or pruning the cache at 
+        # the same time, so entries can disappear at any point.
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(x[1] for x in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def convert(self, src):
+        """
+        Convert the file at `src` and return the path of the result, which is 
+        written next to it with the target extension.
+        """
+        root, extension = os.path.splitext(src)
+        target_extension, func = self.converters[extension]
+        dst = f"{root}{target_extension}"
+        with open(src, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        cached = os.path.join(self.cache_dir, f"{digest}{target_extension}")
+        try:
+            os.utime(cached)
+            shutil.copyfile(cached, dst)
+            self.hits += 1
+            return dst
+        except FileNotFoundError:
+            # Not cached, or pruned in the meantime.
+            pass
+        self.misses += 1
+        with self.semaphore:
+            func(src, dst, self.timeout)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(dst, tmp)
+            os.replace(tmp, cached)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._prune()
+        return dst
+
+service = ConverterService()
+service.register(".hwp", ".html", hwp_to_html)
+service.register(".xls", ".xlsx", xls_to_xlsx_in_process)
+
+if __name__ == "__main__":
+    # Entry point of `xls_to_xlsx_in_process`.
+    xls_to_xlsx(sys.argv[1], sys.argv[2])
@@ -1,2 +1,6 @@
 from .retrieve_from_web import retrieve_from_web, retrieve_from_web_json
-from .generate_image import generate_image, generate_image_json
\ No newline at end of file
+from .generate_image import generate_image, generate_image_json
+from .registry import registry, register, enable_cache, disable_cache, get_tools, call, dispatch
+
+register(retrieve_from_web_json, retrieve_from_web)
+register(generate_image_json, generate_image)
\ No newline at end of file
@@ -1,5 +1,7 @@
 import openai
 
+_client = None
+
 generate_image_json = {
     "name": "generate_image",
     "description": "Generate an image based on a prompt.",
@@ -15,9 +17,24 @@ generate_image_json = {
     }
 }
 
+def get_client():
+    """
+    Returns the OpenAI client shared by all calls, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        _client = openai.OpenAI()
+    return _client
+
+def set_client(client):
+    """
+    Replace the shared OpenAI client, e.g. with a local fake.
+    """
+    global _client
+    _client = client
+
 def generate_image(prompt):
-    client = openai.OpenAI()
-    response = client.images.generate(
+    response = get_client().images.generate(
         model="dall-e-3",
         prompt=prompt,
         size="1024x1024",
@@ -0,0 +1,86 @@
+import json, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from ..cache import LRUCache, DiskCache
+
+registry = {}
+
+def register(schema, function, timeout=60):
+    """
+    Register a function tool under the name given in its JSON schema.
+    """
+    registry[schema["name"]] = {"function": function, "schema": schema, "timeout": timeout, "cache": None}
+
+def enable_cache(name, ttl=3600, max_entries=256, path=None):
+    """
+    Cache the results of a registered function, keyed by its name and 
+    normalized arguments. Results are kept in memory, or on disk under `path` if it is 
+    given.
+    """
+    if path is None:
+        registry[name]["cache"] = LRUCache(max_entries=max_entries, ttl=ttl)
+    else:
+        registry[name]["cache"] = DiskCache(path, max_entries=max_entries, ttl=ttl)
+
+def disable_cache(name):
+    registry[name]["cache"] = None
+
+def normalize(arguments):
+    """
+    Normalize JSON-encoded arguments so that calls differing only in key 
+    order or surrounding whitespace share a cache entry.
+    """
+    arguments = json.loads(arguments or "{}")
+    arguments = {k: v.strip() if isinstance(v, str) else v for k, v in arguments.items()}
+    return json.dumps(arguments, sort_keys=True)
+
+def get_tools():
+    """
+    Returns the registered functions as tools for creating an assistant.
+    """
+    return [{"type": "function", "function": x["schema"]} for x in registry.values()]
+
+def call(name, arguments):
+    """
+    Call a registered function with its JSON-encoded arguments and return 
+    the output as a string, using the function's cache if it is enabled.
+    """
+    if name not in registry:
+        return f"Error: Unknown function: {name}"
+    arguments = normalize(arguments)
+    def run():
+        output = registry[name]["function"](**json.loads(arguments))
+        return output if isinstance(output, str) else json.dumps(output)
+    if registry[name]["cache"] is None:
+        return run()
+    # Key by name as well, since several functions may share a disk cache.
+    return registry[name]["cache"].get_or_set((name, arguments), run)
+
+def dispatch(tool_calls, max_workers=8):
+    """
+    Run the requested tool calls concurrently, each limited by the timeout 
+    it was registered with. Returns the tool outputs, ready to be submitted 
+    in one request, and the latency of each call in seconds.
+    """
+    def run(tool_call):
+        start = time.perf_counter()
+        try:
+            output = call(tool_call.function.name, tool_call.function.arguments)
+        except Exception as e:
+            output = f"Error: {e}"
+        return output, time.perf_counter() - start
+
+    tool_outputs, latencies = [], []
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    start = time.perf_counter()
+    futures = [executor.submit(run, x) for x in tool_calls]
+    for tool_call, future in zip(tool_calls, futures):
+        timeout = registry.get(tool_call.function.name, {}).get("timeout", 60)
+        try:
+            output, latency = future.result(timeout=max(start + timeout - time.perf_counter(), 0))
+        except TimeoutError:
+            output, latency = f"Error: Timed out after {timeout} seconds", time.perf_counter() - start
+        tool_outputs.append({"tool_call_id": tool_call.id, "output": output})
+        latencies.append({"name": tool_call.function.name, "tool_call_id": tool_call.id, "latency": latency})
+    # Do not wait for calls that timed out.
+    executor.shutdown(wait=False)
+    return tool_outputs, latencies
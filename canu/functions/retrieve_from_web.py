@@ -1,4 +1,4 @@
-from langchain_google_community import GoogleSearchAPIWrapper
+_client = None
 
 retrieve_from_web_json = {
     "name": "retrieve_from_web",
@@ -15,7 +15,23 @@ retrieve_from_web_json = {
     }
 }
 
+def get_client():
+    """
+    Returns the search client shared by all calls, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        from langchain_google_community import GoogleSearchAPIWrapper
+        _client = GoogleSearchAPIWrapper()
+    return _client
+
+def set_client(client):
+    """
+    Replace the shared search client, e.g. with a local fake.
+    """
+    global _client
+    _client = client
+
 def retrieve_from_web(query):
-    search = GoogleSearchAPIWrapper()
-    result = search.run(query)
+    result = get_client().run(query)
     return result
\ No newline at end of file
@@ -0,0 +1,608 @@
+import io, os, sys, gzip, json, time, yaml, pickle, sqlite3, hashlib, functools, threading
+from .cache import LRUCache
+
+# Conversations are saved as a small JSON index of `[role, blocks]` pairs.
+# Binary block content (e.g. images) is moved to a content-addressed blob
+# store under `blobs/<sha256>` and referenced from the index by its digest.
+VERSION = 2
+
+class LocalHistory():
+    """
+    Store conversations on the local file system under `root/<username>`.
+    """
+    def __init__(self, root="./users"):
+        self.root = root
+
+    def _path(self, username, key):
+        return os.path.join(self.root, username, key)
+
+    def list_users(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [x for x in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, x))]
+
+    def list_keys(self, username):
+        folder = os.path.join(self.root, username)
+        if not os.path.isdir(folder):
+            return []
+        return os.listdir(folder)
+
+    def exists(self, username, key):
+        return os.path.exists(self._path(username, key))
+
+    def read(self, username, key):
+        with open(self._path(username, key), 'rb') as f:
+            return f.read()
+
+    def write(self, username, key, data):
+        path = self._path(username, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def delete(self, username, key):
+        if self.exists(username, key):
+            os.remove(self._path(username, key))
+
+    def open_index(self, username):
+        return get_search_index(os.path.join(self.root, "search.db"))
+
+    def edit_index(self, username, func):
+        index = self.open_index(username)
+        func(index)
+        return index
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client(aws_access_key_id, aws_secret_access_key):
+    """
+    Return an S3 client shared by all sessions in the process.
+    """
+    import boto3
+    return boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key
+    )
+
+# Local copies of the users' search indexes kept in S3, and the ETag of the 
+# version each copy was downloaded from.
+search_cache_dir = "./.canu/search"
+s3_index_etags = {}
+s3_index_lock = threading.Lock()
+
+# Listings of each user's folder, shared by all sessions in the process and 
+# invalidated whenever the folder is written to or deleted from.
+s3_listing_cache = LRUCache(max_entries=1024, ttl=60)
+
+class S3History():
+    """
+    Store conversations in an S3 bucket under `users_dir/<username>`. If 
+    `compression` is True, conversation indexes are gzip-compressed.
+    """
+    def __init__(self, bucket, users_dir, aws_access_key_id, aws_secret_access_key, compression=False):
+        self.bucket = bucket
+        self.users_dir = users_dir
+        self.compression = compression
+        self.s3 = get_s3_client(aws_access_key_id, aws_secret_access_key)
+
+    def _key(self, username, key):
+        return f"{self.users_dir}/{username}/{key}"
+
+    def _list(self, prefix):
+        keys, prefixes = [], []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter="/"):
+            keys.extend(x['Key'][len(prefix):] for x in page.get('Contents', []))
+            prefixes.extend(x['Prefix'][len(prefix):].rstrip('/') for x in page.get('CommonPrefixes', []))
+        return keys, prefixes
+
+    def list_users(self):
+        return self._list(f"{self.users_dir}/")[1]
+
+    def list_keys(self, username):
+        prefix = self._key(username, "")
+        return s3_listing_cache.get_or_set((self.bucket, prefix), lambda: self._list(prefix)[0])
+
+    def exists(self, username, key):
+        import botocore.exceptions
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self._key(username, key))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return False
+            raise
+        return True
+
+    def read(self, username, key):
+        buffer = io.BytesIO()
+        self.s3.download_fileobj(self.bucket, self._key(username, key), buffer)
+        data = buffer.getvalue()
+        if key.endswith('.json') and data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return data
+
+    def write(self, username, key, data):
+        extra_args = None
+        if self.compression and key.endswith('.json'):
+            data = gzip.compress(data)
+            extra_args = {'ContentEncoding': 'gzip'}
+        self.s3.upload_fileobj(io.BytesIO(data), self.bucket, self._key(username, key), ExtraArgs=extra_args)
+        s3_listing_cache.pop((self.bucket, self._key(username, "")))
+
+    def delete(self, username, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(username, key))
+        s3_listing_cache.pop((self.bucket, self._key(username, "")))
+
+    def _index_path(self, username):
+        digest = hashlib.sha256(f"{self.bucket}/{self._key(username, 'search.db')}".encode("utf-8")).hexdigest()
+        return os.path.join(search_cache_dir, f"{digest}.db")
+
+    def open_index(self, username):
+        """
+        Return the user's search index, which is kept next to their 
+        conversations as `search.db` and downloaded to `search_cache_dir` 
+        again only when its ETag has changed.
+        """
+        import botocore.exceptions
+        key = self._key(username, "search.db")
+        path = self._index_path(username)
+        index = get_search_index(path, wal=False)
+        try:
+            etag = self.s3.head_object(Bucket=self.bucket, Key=key)['ETag']
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                raise
+            etag = None
+        if etag is not None and s3_index_etags.get(path) != etag:
+            os.makedirs(search_cache_dir, exist_ok=True)
+            self.s3.download_file(self.bucket, key, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            index.reload()
+        s3_index_etags[path] = etag
+        return index
+
+    def edit_index(self, username, func, retries=5):
+        """
+        Apply `func(index)` to the user's search index and upload it. The 
+        whole index is uploaded, so it is only written if it has not changed 
+        in S3 since it was downloaded. Otherwise the latest index is 
+        downloaded and `func` is applied to it again, so that concurrent 
+        writers merge their changes instead of overwriting each other. The 
+        local copy is assumed to be current at first, so an edit usually 
+        takes a single request.
+        """
+        import botocore.exceptions
+        key = self._key(username, "search.db")
+        path = self._index_path(username)
+        with s3_index_lock:
+            for attempt in range(retries):
+                if attempt or path not in s3_index_etags:
+                    index = self.open_index(username)
+                else:
+                    index = get_search_index(path, wal=False)
+                func(index)
+                etag = s3_index_etags[path]
+                condition = {'IfNoneMatch': "*"} if etag is None else {'IfMatch': etag}
+                try:
+                    with open(path, 'rb') as f:
+                        response = self.s3.put_object(Bucket=self.bucket, Key=key, Body=f, **condition)
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                        raise
+                    continue
+                s3_index_etags[path] = response['ETag']
+                return index
+        raise RuntimeError(f"Could not update the search index of {username} after {retries} attempts")
+
+class SQLiteHistory():
+    """
+    Store conversations in a single SQLite database in WAL mode, indexed by 
+    username and the time each conversation was last saved. Each thread 
+    uses its own connection.
+    """
+    def __init__(self, path="./history.db"):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (username, name)
+                );
+                CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (username, updated_at);
+                CREATE TABLE IF NOT EXISTS blobs (
+                    username TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (username, digest)
+                );
+            """)
+            self.local.connection = connection
+        return self.local.connection
+
+    def _split(self, key):
+        if key.startswith("blobs/"):
+            return "blobs", "digest", key[len("blobs/"):]
+        name, extension = os.path.splitext(key)
+        return "conversations", "name", name if extension == ".json" else None
+
+    def list_users(self):
+        return [x[0] for x in self.connection.execute("SELECT DISTINCT username FROM conversations")]
+
+    def list_names(self, username, offset=0, limit=None):
+        """
+        Return the names of the user's conversations, most recently saved 
+        first.
+        """
+        rows = self.connection.execute(
+            "SELECT name FROM conversations WHERE username = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (username, -1 if limit is None else limit, offset)
+        )
+        return [x[0] for x in rows]
+
+    def list_keys(self, username):
+        return [f"{x}.json" for x in self.list_names(username)]
+
+    def exists(self, username, key):
+        table, column, value = self._split(key)
+        if value is None:
+            return False
+        row = self.connection.execute(
+            f"SELECT 1 FROM {table} WHERE username = ? AND {column} = ?", (username, value)
+        ).fetchone()
+        return row is not None
+
+    def read(self, username, key):
+        table, column, value = self._split(key)
+        row = self.connection.execute(
+            f"SELECT data FROM {table} WHERE username = ? AND {column} = ?", (username, value)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def write(self, username, key, data):
+        table, column, value = self._split(key)
+        with self.connection:
+            if table == "blobs":
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO blobs (username, digest, data) VALUES (?, ?, ?)",
+                    (username, value, data)
+                )
+            elif value is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO conversations (username, name, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (username, value, data, time.time())
+                )
+            else:
+                raise ValueError(f"Unsupported key for SQLite history: {key}")
+
+    def delete(self, username, key):
+        table, column, value = self._split(key)
+        if value is None:
+            return
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {table} WHERE username = ? AND {column} = ?", (username, value))
+
+    def open_index(self, username):
+        return get_search_index(self.path)
+
+    def edit_index(self, username, func):
+        index = self.open_index(username)
+        func(index)
+        return index
+
+class SearchIndex():
+    """
+    A full-text index of the text blocks of saved conversations, kept in a 
+    SQLite database and updated whenever a conversation is saved or deleted. 
+    Each turn is a row, so matching turns are found without loading any 
+    conversation. Text is indexed with the FTS5 trigram tokenizer, which also 
+    matches inside words of languages written without spaces. Queries with 
+    terms shorter than three characters, or SQLite builds without FTS5, fall 
+    back to scanning the user's turns. Each thread uses its own connection.
+    """
+    def __init__(self, path, wal=True):
+        self.path = path
+        self.wal = wal
+        self.local = threading.local()
+        self.generation = 0
+
+    def reload(self):
+        """
+        Reopen the connections, e.g. after the database file was replaced.
+        """
+        self.generation += 1
+
+    @property
+    def connection(self):
+        if getattr(self.local, 'generation', None) != self.generation:
+            if hasattr(self.local, 'connection'):
+                self.local.connection.close()
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            if self.wal:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS search_conversations (
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (username, name)
+                );
+                CREATE TABLE IF NOT EXISTS search_turns (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    turn INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    text TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS search_turns_name ON search_turns (username, name);
+            """)
+            try:
+                connection.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS search_turns_fts USING fts5(
+                        text, content='search_turns', content_rowid='id', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS search_turns_insert AFTER INSERT ON search_turns BEGIN
+                        INSERT INTO search_turns_fts (rowid, text) VALUES (new.id, new.text);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS search_turns_delete AFTER DELETE ON search_turns BEGIN
+                        INSERT INTO search_turns_fts (search_turns_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    END;
+                """)
+                self.local.fts = True
+            except sqlite3.OperationalError:
+                self.local.fts = False
+            self.local.connection = connection
+            self.local.generation = self.generation
+        return self.local.connection
+
+    def names(self, username):
+        rows = self.connection.execute("SELECT name FROM search_conversations WHERE username = ?", (username,))
+        return {x[0] for x in rows}
+
+    def update(self, username, name, messages):
+        """
+        Replace the indexed turns of a conversation given as a list of 
+        `[role, blocks]` pairs.
+        """
+        rows = []
+        for turn, (role, blocks) in enumerate(messages):
+            text = "\n".join(x['content'] for x in blocks if x.get('type') == 'text' and isinstance(x.get('content'), str))
+            if text:
+                rows.append((username, name, turn, role, text))
+        with self.connection:
+            self.connection.execute("DELETE FROM search_turns WHERE username = ? AND name = ?", (username, name))
+            self.connection.executemany(
+                "INSERT INTO search_turns (username, name, turn, role, text) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO search_conversations (username, name) VALUES (?, ?)", (username, name)
+            )
+
+    def delete(self, username, name):
+        with self.connection:
+            self.connection.execute("DELETE FROM search_turns WHERE username = ? AND name = ?", (username, name))
+            self.connection.execute("DELETE FROM search_conversations WHERE username = ? AND name = ?", (username, name))
+
+    def search(self, username, query, limit=20):
+        """
+        Return up to `limit` turns of the user's conversations containing 
+        every whitespace-separated term of `query`, best matches first, as 
+        dicts with 'name', 'turn', 'role' and 'snippet' keys.
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        connection = self.connection
+        if self.local.fts and all(len(x) >= 3 for x in terms):
+            rows = connection.execute(
+                "SELECT t.name, t.turn, t.role, t.text FROM search_turns_fts f JOIN search_turns t ON t.id = f.rowid "
+                "WHERE search_turns_fts MATCH ? AND t.username = ? ORDER BY bm25(search_turns_fts) LIMIT ?",
+                (" ".join('"' + x.replace('"', '""') + '"' for x in terms), username, limit)
+            )
+        else:
+            patterns = ["%" + x.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for x in terms]
+            rows = connection.execute(
+                "SELECT name, turn, role, text FROM search_turns WHERE username = ? AND "
+                + " AND ".join(["text LIKE ? ESCAPE '\\'"] * len(terms))
+                + " ORDER BY name, turn LIMIT ?",
+                (username, *patterns, limit)
+            )
+        return [{'name': name, 'turn': turn, 'role': role, 'snippet': _snippet(text, terms)} for name, turn, role, text in rows]
+
+def _snippet(text, terms, width=160):
+    lower = text.lower()
+    positions = [lower.find(x.lower()) for x in terms]
+    position = min([x for x in positions if x >= 0], default=0)
+    start = max(0, position - width // 4)
+    end = min(len(text), start + width)
+    snippet = " ".join(text[start:end].split())
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+@functools.lru_cache(maxsize=None)
+def get_search_index(path, wal=True):
+    """
+    Return a search index shared by all sessions in the process.
+    """
+    return SearchIndex(path, wal=wal)
+
+@functools.lru_cache(maxsize=None)
+def get_sqlite_history(path):
+    """
+    Return a SQLite history store shared by all sessions in the process.
+    """
+    return SQLiteHistory(path)
+
+def get_store(config):
+    """
+    Create a history store based on the storage method specified in the
+    config.yaml file. Currently, the supported methods are 'LOCAL', 'S3' and 
+    'SQLITE'.
+    """
+    method = config['history']['method']
+    if method == "LOCAL":
+        return LocalHistory()
+    elif method == "S3":
+        return S3History(
+            config['history']['bucket'],
+            config['history']['users_dir'],
+            config['history']['aws_access_key_id'],
+            config['history']['aws_secret_access_key'],
+            compression=config['history'].get('compression', False)
+        )
+    elif method == "SQLITE":
+        return get_sqlite_history(config['history'].get('path', "./history.db"))
+    else:
+        raise ValueError(f"Invalid history storage method: {method}")
+
+def put_blob(store, username, data):
+    """
+    Add binary content to the blob store and return its SHA-256 digest.
+    Content that is already stored is not written again.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if not store.exists(username, f"blobs/{digest}"):
+        store.write(username, f"blobs/{digest}", data)
+    return digest
+
+def get_blob(store, username, digest):
+    return store.read(username, f"blobs/{digest}")
+
+def list_conversations(store, username, offset=0, limit=None):
+    """
+    Return the names of the user's conversations, paginated by `offset` and 
+    `limit`.
+    """
+    if hasattr(store, 'list_names'):
+        return store.list_names(username, offset=offset, limit=limit)
+    names = []
+    for key in sorted(store.list_keys(username)):
+        name, extension = os.path.splitext(key)
+        if extension in ['.json', '.pkl'] and name not in names:
+            names.append(name)
+    return names[offset:None if limit is None else offset + limit]
+
+def save_conversation(store, username, name, data):
+    """
+    Save a conversation given as a list of `[role, blocks]` pairs. Blocks are
+    dicts with either a 'content' key or, for content already in the blob
+    store, 'blob' and 'size' keys. Binary content is moved to the blob store.
+    """
+    messages = []
+    for role, blocks in data:
+        records = []
+        for block in blocks:
+            if isinstance(block.get('content'), (bytes, bytearray)):
+                digest = put_blob(store, username, block['content'])
+                block = {'type': block['type'], 'blob': digest, 'size': len(block['content'])}
+            records.append(block)
+        messages.append([role, records])
+    index = json.dumps({'version': VERSION, 'messages': messages}, ensure_ascii=False)
+    store.write(username, f"{name}.json", index.encode("utf-8"))
+    update_index(store, username, name, messages)
+
+def load_conversation(store, username, name):
+    """
+    Load a conversation as a list of `[role, blocks]` pairs. Blob content is
+    not loaded; such blocks are returned with 'blob' and 'size' keys.
+    Conversations in the legacy .pkl format are loaded as well.
+    """
+    if store.exists(username, f"{name}.json"):
+        return json.loads(store.read(username, f"{name}.json"))['messages']
+    return pickle.loads(store.read(username, f"{name}.pkl"))
+
+def _blob_digests(messages):
+    return {x['blob'] for _, blocks in messages for x in blocks if 'blob' in x}
+
+def delete_conversation(store, username, name, detach=None):
+    """
+    Delete a conversation along with the blobs that no other conversation 
+    refers to. If `detach` is given, it is called with the digests of those 
+    blobs before they are deleted, e.g. to load blocks that are still on 
+    screen.
+    """
+    digests = set()
+    if store.exists(username, f"{name}.json"):
+        digests = _blob_digests(json.loads(store.read(username, f"{name}.json"))['messages'])
+    store.delete(username, f"{name}.json")
+    store.delete(username, f"{name}.pkl")
+    update_index(store, username, name)
+    # Conversations in the legacy .pkl format keep their content inline.
+    for key in store.list_keys(username):
+        if not digests:
+            break
+        if key.endswith('.json'):
+            digests -= _blob_digests(json.loads(store.read(username, key))['messages'])
+    if digests and detach is not None:
+        detach(digests)
+    for digest in digests:
+        store.delete(username, f"blobs/{digest}")
+
+def update_index(store, username, name, messages=None):
+    """
+    Add a saved conversation to the store's search index, or remove it if 
+    `messages` is None. Stores without a search index are skipped.
+    """
+    if not hasattr(store, 'edit_index'):
+        return
+    def edit(index):
+        if messages is None:
+            index.delete(username, name)
+        else:
+            index.update(username, name, messages)
+    store.edit_index(username, edit)
+
+def search_conversations(store, username, query, limit=20):
+    """
+    Search the text blocks of the user's conversations and return matching 
+    turns with snippets (see `SearchIndex.search`). Conversations saved 
+    before the index existed, or removed by another process, are added to or 
+    removed from the index first; nothing else is loaded.
+    """
+    if not hasattr(store, 'edit_index'):
+        return []
+    index = store.open_index(username)
+    names = set(list_conversations(store, username))
+    if index.names(username) != names:
+        def edit(index):
+            indexed = index.names(username)
+            for name in indexed - names:
+                index.delete(username, name)
+            for name in names - indexed:
+                index.update(username, name, load_conversation(store, username, name))
+        index = store.edit_index(username, edit)
+    return index.search(username, query, limit=limit)
+
+def migrate(store, remove_legacy=False):
+    """
+    Convert every conversation saved in the legacy .pkl format to the
+    current format. Run `python -m canu.history [--remove-legacy]` from the
+    directory containing config.yaml to migrate the configured store.
+    """
+    for username in store.list_users():
+        for key in store.list_keys(username):
+            name, extension = os.path.splitext(key)
+            if extension != '.pkl' or store.exists(username, f"{name}.json"):
+                continue
+            save_conversation(store, username, name, pickle.loads(store.read(username, key)))
+            if remove_legacy:
+                store.delete(username, key)
+            print(f"Migrated conversation: {username}/{name}")
+
+if __name__ == "__main__":
+    with open("./config.yaml") as f:
+        config = yaml.load(f, Loader=yaml.loader.SafeLoader)
+    migrate(get_store(config), remove_legacy="--remove-legacy" in sys.argv)
@@ -0,0 +1,258 @@
+import os, json, time, bisect, functools, threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram():
+    """
+    A cumulative histogram with fixed bucket upper bounds, as used by
+    Prometheus.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class Registry():
+    """
+    A thread-safe collection of counters and histograms shared by all
+    sessions in the process. Metrics are keyed by name and a sorted tuple of
+    label pairs.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, help, buckets=None):
+        self.help[name] = help
+        if buckets is not None:
+            self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+            self.histograms[key].observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON-serializable dictionary.
+        """
+        with self.lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda x: x[0])
+            ]
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        def format_labels(labels, **extra):
+            labels = {**labels, **extra}
+            if not labels:
+                return ""
+            pairs = []
+            for k, v in labels.items():
+                v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+                pairs.append(f'{k}="{v}"')
+            return "{" + ",".join(pairs) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        seen = set()
+        for counter in snapshot['counters']:
+            name = counter['name']
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(counter['labels'])} {counter['value']}")
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in histogram['buckets'].items():
+                lines.append(f"{name}_bucket{format_labels(histogram['labels'], le=bound)} {count}")
+            lines.append(f"{name}_sum{format_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+registry.describe("canu_openai_requests_total", "OpenAI API calls by operation and outcome.")
+registry.describe("canu_openai_request_seconds", "Latency of OpenAI API calls by operation.")
+registry.describe("canu_run_seconds", "Wall time of streamed runs.")
+registry.describe("canu_time_to_first_token_seconds", "Time from the start of a run to its first text or code delta.")
+registry.describe("canu_tokens_per_second", "Completion tokens per second of streamed runs.", RATE_BUCKETS)
+registry.describe("canu_renders_per_run", "Number of renders of the assistant message per run.", COUNT_BUCKETS)
+registry.describe("canu_renders_total", "Renders of chat messages by mode.")
+registry.describe("canu_render_seconds", "Time spent rendering chat messages by mode.")
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+@contextmanager
+def timer(operation):
+    """
+    Count an OpenAI API call and record its latency under `operation`.
+    """
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        registry.observe("canu_openai_request_seconds", time.perf_counter() - start, operation=operation)
+        registry.inc("canu_openai_requests_total", operation=operation, status=status)
+
+def timed(operation):
+    """
+    A decorator version of `timer`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class RunMetrics():
+    """
+    Timings of a single streamed run. `start` is called when the run is
+    requested, `token` on every text or code delta and `end` once the run
+    has finished. If the API reports usage, tokens per second is based on
+    the completion tokens; otherwise on the number of deltas.
+    """
+    __slots__ = ('started', 'first_token', 'deltas', 'completion_tokens', 'renders', 'ended')
+
+    def __init__(self):
+        self.started = None
+        self.first_token = None
+        self.deltas = 0
+        self.completion_tokens = None
+        self.renders = 0
+        self.ended = False
+
+    def start(self):
+        if self.started is None:
+            self.started = time.perf_counter()
+
+    def token(self):
+        self.deltas += 1
+        if self.first_token is None and self.started is not None:
+            self.first_token = time.perf_counter()
+
+    def end(self):
+        if self.started is None or self.ended:
+            return
+        self.ended = True
+        elapsed = time.perf_counter() - self.started
+        registry.observe("canu_run_seconds", elapsed)
+        registry.observe("canu_renders_per_run", self.renders)
+        if self.first_token is not None:
+            registry.observe("canu_time_to_first_token_seconds", self.first_token - self.started)
+            generation = time.perf_counter() - self.first_token
+            tokens = self.completion_tokens if self.completion_tokens is not None else self.deltas
+            if generation > 0:
+                registry.observe("canu_tokens_per_second", tokens / generation)
+
+def snapshot():
+    return registry.snapshot()
+
+def to_prometheus():
+    return registry.to_prometheus()
+
+def write(path):
+    """
+    Write the metrics to `path`, in Prometheus text format if it ends with
+    .prom or .txt and as JSON otherwise. The file is replaced atomically so
+    that it can be scraped by a node exporter's textfile collector.
+    """
+    if path.endswith((".prom", ".txt")):
+        text = to_prometheus()
+    else:
+        text = json.dumps(snapshot(), indent=2)
+    with open(f"{path}.tmp", "w") as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def serve(port=9464, host="127.0.0.1"):
+    """
+    Serve the metrics at /metrics (Prometheus) and /metrics.json (JSON) from
+    a background thread. Only one server is started per process, so it is
+    safe to call on every rerun.
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _Handler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
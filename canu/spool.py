@@ -0,0 +1,93 @@
+import os, shutil, weakref, tempfile, threading
+
+class SpooledFile():
+    """
+    A file spooled to disk. Its content is only read when requested, and it
+    is fetched again with `fetch(file_id, path)` if it has been evicted.
+    """
+    __slots__ = ('path', 'file_id', 'fetch')
+
+    def __init__(self, path, file_id, fetch):
+        self.path = path
+        self.file_id = file_id
+        self.fetch = fetch
+
+    def read(self):
+        if not os.path.exists(self.path):
+            self.fetch(self.file_id, self.path)
+        os.utime(self.path)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+class SpoolSession():
+    """
+    The spool directory of a single session. The directory is removed when
+    the object is garbage collected, i.e. when the session ends.
+    """
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=root)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+class Spool():
+    """
+    A size-capped directory for large files such as code interpreter
+    outputs, shared by all sessions in the process. Once the spool grows
+    beyond `max_bytes`, the least recently used files are evicted.
+    """
+    def __init__(self, root=None, max_bytes=2 * 1024 * 1024 * 1024):
+        self.root = root or os.path.join(tempfile.gettempdir(), "canu-spool")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def create_session(self):
+        return SpoolSession(self.root)
+
+    def write(self, path, chunks):
+        """
+        Write an iterable of byte chunks to `path` and evict old files if
+        the spool is over its size cap.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(f"{path}.tmp", path)
+        self.evict(keep=path)
+
+    async def write_async(self, path, chunks):
+        """
+        Like `write`, but for an asynchronous iterable of byte chunks.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+        os.replace(f"{path}.tmp", path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        with self.lock:
+            files = []
+            for root, _, names in os.walk(self.root):
+                for name in names:
+                    # Skip files that are still being written.
+                    if name.endswith('.tmp'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            size = sum(x[1] for x in files)
+            for _, file_size, path in sorted(files):
+                if size <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= file_size
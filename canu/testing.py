@@ -0,0 +1,520 @@
+import json, time, uuid, base64, typing, asyncio, threading
+from types import SimpleNamespace
+from collections import Counter, deque
+from contextlib import contextmanager, asynccontextmanager
+import openai
+from openai.lib.streaming import AssistantStreamManager, AsyncAssistantStreamManager
+from openai.types import FileObject, FileDeleted
+from openai.types.beta import Assistant, Thread, ThreadDeleted, AssistantStreamEvent
+from openai.types.beta.threads import Run, Message, MessageDeleted
+
+# A 1x1 white PNG.
+PIXEL = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4AAAAAElFTkSuQmCC")
+
+EVENT_TYPES = {
+    x.model_fields['event'].annotation.__args__[0]: x
+    for x in typing.get_args(typing.get_args(AssistantStreamEvent)[0])
+}
+
+def text(value):
+    """
+    A text reply, streamed in chunks of `chunk_size` characters.
+    """
+    return {'type': 'text', 'value': value}
+
+def code(input):
+    """
+    A code interpreter call whose input is streamed in chunks.
+    """
+    return {'type': 'code', 'input': input}
+
+def image(file_id, content=PIXEL):
+    """
+    An image file in the reply, e.g. a chart made by the code interpreter.
+    """
+    return {'type': 'image', 'file_id': file_id, 'content': content}
+
+def citation(file_id, filename="source.txt"):
+    """
+    A file citation annotation, as added by file search.
+    """
+    return {'type': 'citation', 'file_id': file_id, 'filename': filename}
+
+def file_path(file_id, filename="output.csv", content=b""):
+    """
+    A link to a file created by the code interpreter.
+    """
+    return {'type': 'file_path', 'file_id': file_id, 'filename': filename, 'content': content}
+
+def function(name, arguments="{}"):
+    """
+    A function call. The run stops with `requires_action` and the remaining
+    items are streamed once the tool outputs are submitted.
+    """
+    return {'type': 'function', 'name': name, 'arguments': arguments}
+
+def to_event(data):
+    """
+    Convert a recorded event, given as a dict with 'event' and 'data' keys,
+    to an `AssistantStreamEvent`.
+    """
+    if not isinstance(data, dict):
+        return data
+    return EVENT_TYPES[data['event']].construct(event=data['event'], data=data['data'])
+
+def load_events(path):
+    """
+    Load events recorded as JSON lines with `dump_events`.
+    """
+    with open(path) as f:
+        return [to_event(json.loads(x)) for x in f if x.strip()]
+
+def dump_events(events, path):
+    """
+    Save events, e.g. those collected from a live stream in `on_event`, as
+    JSON lines that can be replayed with `FakeOpenAI.queue_events`.
+    """
+    with open(path, "w") as f:
+        for event in events:
+            f.write(json.dumps(event.model_dump(mode="json") if not isinstance(event, dict) else event, ensure_ascii=False) + "\n")
+
+def _not_found(message):
+    response = SimpleNamespace(request=None, status_code=404, headers={})
+    return openai.NotFoundError(message, response=response, body=None)
+
+def _bad_request(message):
+    response = SimpleNamespace(request=None, status_code=400, headers={})
+    return openai.BadRequestError(message, response=response, body=None)
+
+def _id(prefix):
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+class FakeStream():
+    """
+    A stream of events, replayed with `delay` seconds between deltas.
+    """
+    def __init__(self, client, thread_id, run, events):
+        self.client = client
+        self.thread_id = thread_id
+        self.run = run
+        self.events = events
+        self.closed = False
+
+    def _events(self):
+        for event in self.events:
+            if self.closed:
+                return
+            event = to_event(event)
+            if event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step.'):
+                self.run.update(event.data.model_dump(exclude_unset=True), id=self.run['id'], thread_id=self.thread_id)
+                event = EVENT_TYPES[event.event].construct(event=event.event, data=dict(self.run))
+            yield event
+
+    def __iter__(self):
+        for event in self._events():
+            if event.event.endswith('.delta') and self.client.delay:
+                time.sleep(self.client.delay)
+            yield event
+
+    def close(self):
+        self.closed = True
+
+class FakeAsyncStream(FakeStream):
+    async def __aiter__(self):
+        for event in self._events():
+            if event.event.endswith('.delta') and self.client.delay:
+                await asyncio.sleep(self.client.delay)
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+class FakeOpenAI():
+    """
+    A local stand-in for `openai.OpenAI` that covers the Assistants and Files
+    endpoints used by canu. Runs replay scripts queued with `queue`, which
+    are built from the `text`, `code`, `image`, `citation`, `file_path` and
+    `function` items, or recorded events queued with `queue_events`. When
+    no script is queued, `default` is replayed. Every API call sleeps for
+    `latency` seconds and every delta for `delay` seconds, and calls are
+    counted in `calls`. It can be put in `st.session_state.client`, including
+    under Streamlit's `AppTest`.
+    """
+    def __init__(self, latency=0, delay=0, chunk_size=4, default=None):
+        self.latency = latency
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.default = default or [text("Hello! How can I help you today?")]
+        self.calls = Counter()
+        self.streams = deque()
+        self.resumes = {}
+        self.threads = {}
+        self.tool_resources = {}
+        self.runs = {}
+        self.files = FakeFiles(self)
+        self.beta = SimpleNamespace(
+            assistants=FakeAssistants(self),
+            threads=FakeThreads(self)
+        )
+        self.lock = threading.Lock()
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def queue(self, *items):
+        """
+        Queue a synthetic run made of the given items.
+        """
+        self.streams.append(('items', list(items), False))
+
+    def queue_events(self, events):
+        """
+        Queue recorded events, replayed as they are except for the thread and
+        run ids. If they end with `thread.run.requires_action`, queue the
+        events that follow the tool outputs next.
+        """
+        self.streams.append(('events', [to_event(x) for x in events]))
+
+    def _compile(self, thread_id, run, items, resumed=False):
+        """
+        Build the events of a synthetic run. Items after the first function
+        call are queued for `submit_tool_outputs_stream`.
+        """
+        events = []
+        run_id = run['id']
+        message = None
+        step_id = None
+        deltas = 0
+
+        def emit(name, data):
+            events.append({'event': name, 'data': data})
+
+        def close_message():
+            nonlocal message
+            if message is not None:
+                message['status'] = 'completed'
+                emit('thread.message.completed', json.loads(json.dumps(message)))
+                emit('thread.run.step.completed', {'id': step_id, 'object': 'thread.run.step', 'run_id': run_id, 'thread_id': thread_id, 'type': 'message_creation', 'status': 'completed', 'step_details': {'type': 'message_creation', 'message_creation': {'message_id': message['id']}}})
+                message = None
+
+        def open_message():
+            nonlocal message, step_id
+            if message is None:
+                message = {'id': _id('msg'), 'object': 'thread.message', 'thread_id': thread_id, 'run_id': run_id, 'role': 'assistant', 'status': 'in_progress', 'content': [], 'attachments': [], 'created_at': int(time.time())}
+                step_id = _id('step')
+                emit('thread.run.step.created', {'id': step_id, 'object': 'thread.run.step', 'run_id': run_id, 'thread_id': thread_id, 'type': 'message_creation', 'status': 'in_progress', 'step_details': {'type': 'message_creation', 'message_creation': {'message_id': message['id']}}})
+                emit('thread.message.created', {**message, 'content': []})
+                emit('thread.message.in_progress', {**message, 'content': []})
+            return message
+
+        def text_delta(value, annotation=None):
+            nonlocal deltas
+            message = open_message()
+            if not message['content'] or message['content'][-1]['type'] != 'text':
+                message['content'].append({'type': 'text', 'text': {'value': '', 'annotations': []}})
+            index = len(message['content']) - 1
+            block = message['content'][index]['text']
+            delta = {'index': index, 'type': 'text', 'text': {'value': value}}
+            if annotation is not None:
+                annotation = {'index': len(block['annotations']), 'text': value, 'start_index': len(block['value']), 'end_index': len(block['value']) + len(value), **annotation}
+                delta['text']['annotations'] = [annotation]
+                block['annotations'].append(annotation)
+            block['value'] += value
+            emit('thread.message.delta', {'id': message['id'], 'object': 'thread.message.delta', 'delta': {'role': 'assistant', 'content': [delta]}})
+            deltas += 1
+
+        if not resumed:
+            emit('thread.run.created', {'status': 'queued'})
+            emit('thread.run.queued', {'status': 'queued'})
+        emit('thread.run.in_progress', {'status': 'in_progress', 'required_action': None})
+        for i, item in enumerate(items):
+            if item['type'] == 'text':
+                for j in range(0, len(item['value']), self.chunk_size):
+                    text_delta(item['value'][j:j + self.chunk_size])
+            elif item['type'] == 'citation':
+                self.files._add(item['file_id'], item['filename'], b"", 'assistants')
+                text_delta(f"【{i}†source】", {'type': 'file_citation', 'file_citation': {'file_id': item['file_id']}})
+            elif item['type'] == 'file_path':
+                self.files._add(item['file_id'], f"/mnt/data/{item['filename']}", item['content'], 'assistants_output')
+                text_delta(f"sandbox:/mnt/data/{item['filename']}", {'type': 'file_path', 'file_path': {'file_id': item['file_id']}})
+            elif item['type'] == 'image':
+                self.files._add(item['file_id'], f"{item['file_id']}.png", item['content'], 'assistants_output')
+                message = open_message()
+                index = len(message['content'])
+                message['content'].append({'type': 'image_file', 'image_file': {'file_id': item['file_id']}})
+                emit('thread.message.delta', {'id': message['id'], 'object': 'thread.message.delta', 'delta': {'content': [{'index': index, 'type': 'image_file', 'image_file': {'file_id': item['file_id']}}]}})
+            elif item['type'] == 'code':
+                close_message()
+                code_step_id, call_id = _id('step'), _id('call')
+                emit('thread.run.step.created', {'id': code_step_id, 'object': 'thread.run.step', 'run_id': run_id, 'thread_id': thread_id, 'type': 'tool_calls', 'status': 'in_progress', 'step_details': {'type': 'tool_calls', 'tool_calls': []}})
+                chunks = [""] + [item['input'][j:j + self.chunk_size] for j in range(0, len(item['input']), self.chunk_size)]
+                for j, chunk in enumerate(chunks):
+                    delta = {'index': 0, 'type': 'code_interpreter', 'code_interpreter': {'input': chunk}}
+                    if j == 0:
+                        delta.update(id=call_id, code_interpreter={'input': chunk, 'outputs': []})
+                    emit('thread.run.step.delta', {'id': code_step_id, 'object': 'thread.run.step.delta', 'delta': {'step_details': {'type': 'tool_calls', 'tool_calls': [delta]}}})
+                    deltas += 1
+                emit('thread.run.step.completed', {'id': code_step_id, 'object': 'thread.run.step', 'run_id': run_id, 'thread_id': thread_id, 'type': 'tool_calls', 'status': 'completed', 'step_details': {'type': 'tool_calls', 'tool_calls': [{'id': call_id, 'type': 'code_interpreter', 'code_interpreter': {'input': item['input'], 'outputs': []}}]}})
+            elif item['type'] == 'function':
+                close_message()
+                tool_calls = []
+                for x in items[i:]:
+                    if x['type'] != 'function':
+                        break
+                    tool_calls.append({'id': _id('call'), 'type': 'function', 'function': {'name': x['name'], 'arguments': x['arguments']}})
+                emit('thread.run.requires_action', {'status': 'requires_action', 'required_action': {'type': 'submit_tool_outputs', 'submit_tool_outputs': {'tool_calls': tool_calls}}})
+                with self.lock:
+                    self.resumes[run_id] = items[i + len(tool_calls):]
+                return events
+        close_message()
+        emit('thread.run.completed', {'status': 'completed', 'required_action': None, 'usage': {'prompt_tokens': 0, 'completion_tokens': deltas, 'total_tokens': deltas}})
+        return events
+
+    def _stream(self, thread_id, run, stream_class=FakeStream):
+        with self.lock:
+            if run['id'] in self.resumes:
+                script = ('items', self.resumes.pop(run['id']), True)
+            elif self.streams:
+                script = self.streams.popleft()
+            else:
+                script = ('items', list(self.default), False)
+        if script[0] == 'events':
+            events = script[1]
+        else:
+            events = self._compile(thread_id, run, script[1], resumed=script[2])
+        return stream_class(self, thread_id, run, events)
+
+class FakeFiles():
+    def __init__(self, client):
+        self.client = client
+        self.files = {}
+        self.with_streaming_response = SimpleNamespace(content=self._streaming_content)
+
+    def _add(self, file_id, filename, content, purpose):
+        self.files.setdefault(file_id, (FileObject.construct(id=file_id, object="file", filename=filename, bytes=len(content), purpose=purpose, status="processed", created_at=int(time.time())), content))
+
+    def _get(self, file_id):
+        if file_id not in self.files:
+            raise _not_found(f"No such File object: {file_id}")
+        return self.files[file_id]
+
+    def create(self, file, purpose):
+        self.client._call("files.create")
+        with open(file, 'rb') as f:
+            content = f.read()
+        file_id = _id("file")
+        self._add(file_id, getattr(file, 'name', str(file)), content, purpose)
+        return self.files[file_id][0]
+
+    def retrieve(self, file_id):
+        self.client._call("files.retrieve")
+        return self._get(file_id)[0]
+
+    def content(self, file_id):
+        self.client._call("files.content")
+        content = self._get(file_id)[1]
+        return SimpleNamespace(read=lambda: content, content=content)
+
+    @contextmanager
+    def _streaming_content(self, file_id):
+        self.client._call("files.content")
+        content = self._get(file_id)[1]
+        yield SimpleNamespace(iter_bytes=lambda chunk_size=65536: (content[i:i + chunk_size] for i in range(0, len(content), chunk_size)))
+
+    def delete(self, file_id):
+        self.client._call("files.delete")
+        self.files.pop(file_id, None)
+        return FileDeleted.construct(id=file_id, object="file", deleted=True)
+
+class FakeAssistants():
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, **kwargs):
+        self.client._call("assistants.create")
+        return Assistant.construct(**{'id': _id("asst"), 'object': "assistant", 'created_at': int(time.time()), 'tools': [], **kwargs})
+
+    def retrieve(self, assistant_id):
+        self.client._call("assistants.retrieve")
+        return Assistant.construct(id=assistant_id, object="assistant", created_at=int(time.time()), tools=[])
+
+class Page(list):
+    @property
+    def data(self):
+        return list(self)
+
+class FakeThreads():
+    def __init__(self, client):
+        self.client = client
+        self.messages = FakeMessages(client)
+        self.runs = FakeRuns(client)
+
+    def create(self, messages=None, tool_resources=None):
+        self.client._call("threads.create")
+        if len(messages or []) > 32:
+            raise _bad_request("'messages': array too long. Expected an array with maximum length 32.")
+        thread_id = _id("thread")
+        with self.client.lock:
+            self.client.threads[thread_id] = []
+            self.client.tool_resources[thread_id] = tool_resources or None
+            self.client.runs[thread_id] = []
+        for message in messages or []:
+            self.messages._add(thread_id, message['role'], message['content'])
+        return self._get(thread_id)
+
+    def _get(self, thread_id):
+        if thread_id not in self.client.threads:
+            raise _not_found(f"No thread found with id '{thread_id}'.")
+        return Thread.model_validate({
+            'id': thread_id, 'object': "thread", 'created_at': int(time.time()), 'metadata': {},
+            'tool_resources': self.client.tool_resources.get(thread_id)
+        })
+
+    def retrieve(self, thread_id):
+        self.client._call("threads.retrieve")
+        return self._get(thread_id)
+
+    def delete(self, thread_id):
+        self.client._call("threads.delete")
+        with self.client.lock:
+            self.client.threads.pop(thread_id, None)
+            self.client.tool_resources.pop(thread_id, None)
+            self.client.runs.pop(thread_id, None)
+        return ThreadDeleted.construct(id=thread_id, object="thread.deleted", deleted=True)
+
+class FakeMessages():
+    def __init__(self, client):
+        self.client = client
+
+    def _add(self, thread_id, role, content, attachments=None):
+        if isinstance(content, str):
+            content = [{'type': 'text', 'text': content}]
+        content = [{'type': 'text', 'text': {'value': x['text'], 'annotations': []}} if x['type'] == 'text' else x for x in content]
+        message = Message.construct(id=_id("msg"), object="thread.message", thread_id=thread_id, role=role, content=content, attachments=attachments, status="completed", created_at=int(time.time()))
+        with self.client.lock:
+            self.client.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    def create(self, thread_id, role, content, attachments=None):
+        self.client._call("messages.create")
+        return self._add(thread_id, role, content, attachments)
+
+    def list(self, thread_id, **kwargs):
+        self.client._call("messages.list")
+        with self.client.lock:
+            return Page(reversed(self.client.threads.get(thread_id, [])))
+
+    def delete(self, message_id, thread_id):
+        self.client._call("messages.delete")
+        with self.client.lock:
+            messages = self.client.threads.get(thread_id, [])
+            messages[:] = [x for x in messages if x.id != message_id]
+        return MessageDeleted.construct(id=message_id, object="thread.message.deleted", deleted=True)
+
+class FakeRuns():
+    def __init__(self, client):
+        self.client = client
+
+    def _find(self, thread_id, run_id):
+        for run in self.client.runs.get(thread_id, []):
+            if run['id'] == run_id:
+                return run
+        raise _not_found(f"No run found with id '{run_id}'.")
+
+    def _create(self, thread_id, assistant_id):
+        run = {'id': _id("run"), 'object': 'thread.run', 'thread_id': thread_id, 'assistant_id': assistant_id, 'status': 'queued', 'required_action': None, 'usage': None, 'created_at': int(time.time())}
+        with self.client.lock:
+            self.client.runs.setdefault(thread_id, []).insert(0, run)
+        return run
+
+    def stream(self, thread_id, assistant_id, event_handler=None, **kwargs):
+        self.client._call("runs.stream")
+        run = self._create(thread_id, assistant_id)
+        return AssistantStreamManager(lambda: self.client._stream(thread_id, run), event_handler=event_handler or openai.AssistantEventHandler())
+
+    def submit_tool_outputs_stream(self, thread_id, run_id, tool_outputs, event_handler=None, **kwargs):
+        self.client._call("runs.submit_tool_outputs_stream")
+        run = self._find(thread_id, run_id)
+        return AssistantStreamManager(lambda: self.client._stream(thread_id, run), event_handler=event_handler or openai.AssistantEventHandler())
+
+    def list(self, thread_id, limit=20, **kwargs):
+        self.client._call("runs.list")
+        with self.client.lock:
+            runs = list(self.client.runs.get(thread_id, []))[:limit]
+        return Page(Run.construct(**x) for x in runs)
+
+    def retrieve(self, run_id, thread_id):
+        self.client._call("runs.retrieve")
+        return Run.construct(**self._find(thread_id, run_id))
+
+class FakeAsyncOpenAI():
+    """
+    A stand-in for `openai.AsyncOpenAI` covering the endpoints used by
+    `canu.AsyncEventHandler`: streaming runs and submitting tool outputs, and
+    retrieving files. It shares its threads, files and queued scripts with
+    the `FakeOpenAI` given as `client`, and waits without blocking the event
+    loop.
+    """
+    def __init__(self, client=None):
+        self.client = client if client is not None else FakeOpenAI()
+        self.files = FakeAsyncFiles(self)
+        self.beta = SimpleNamespace(threads=SimpleNamespace(runs=FakeAsyncRuns(self)))
+
+    async def _call(self, name):
+        with self.client.lock:
+            self.client.calls[name] += 1
+        if self.client.latency:
+            await asyncio.sleep(self.client.latency)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+class FakeAsyncFiles():
+    def __init__(self, client):
+        self.client = client
+        self.with_streaming_response = SimpleNamespace(content=self._streaming_content)
+
+    async def retrieve(self, file_id):
+        await self.client._call("files.retrieve")
+        return self.client.client.files._get(file_id)[0]
+
+    async def content(self, file_id):
+        await self.client._call("files.content")
+        content = self.client.client.files._get(file_id)[1]
+        return SimpleNamespace(read=lambda: content, content=content)
+
+    @asynccontextmanager
+    async def _streaming_content(self, file_id):
+        await self.client._call("files.content")
+        content = self.client.client.files._get(file_id)[1]
+        async def iter_bytes(chunk_size=65536):
+            for i in range(0, len(content), chunk_size):
+                yield content[i:i + chunk_size]
+        yield SimpleNamespace(iter_bytes=iter_bytes)
+
+class FakeAsyncRuns():
+    def __init__(self, client):
+        self.client = client
+
+    def stream(self, thread_id, assistant_id, event_handler=None, **kwargs):
+        async def request():
+            await self.client._call("runs.stream")
+            run = self.client.client.beta.threads.runs._create(thread_id, assistant_id)
+            return self.client.client._stream(thread_id, run, FakeAsyncStream)
+        return AsyncAssistantStreamManager(request(), event_handler=event_handler or openai.AsyncAssistantEventHandler())
+
+    def submit_tool_outputs_stream(self, thread_id, run_id, tool_outputs, event_handler=None, **kwargs):
+        async def request():
+            await self.client._call("runs.submit_tool_outputs_stream")
+            run = self.client.client.beta.threads.runs._find(thread_id, run_id)
+            return self.client.client._stream(thread_id, run, FakeAsyncStream)
+        return AsyncAssistantStreamManager(request(), event_handler=event_handler or openai.AsyncAssistantEventHandler())
@@ -0,0 +1,87 @@
+import os, sqlite3, hashlib, threading
+
+class UploadIndex():
+    """
+    A reference-counted index of files uploaded to OpenAI, keyed by the
+    SHA-256 of their content and their purpose. The index is stored in
+    SQLite so it survives restarts, and is shared by all sessions.
+    """
+    def __init__(self, path="./.canu/uploads.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    digest TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    file_id TEXT NOT NULL UNIQUE,
+                    refcount INTEGER NOT NULL,
+                    PRIMARY KEY (digest, purpose)
+                )
+            """)
+            self._connection = connection
+        return self._connection
+
+    def _acquire(self, digest, purpose):
+        row = self.connection.execute(
+            "SELECT file_id FROM uploads WHERE digest = ? AND purpose = ?", (digest, purpose)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE uploads SET refcount = refcount + 1 WHERE file_id = ?", row)
+        return row[0]
+
+    def acquire(self, file_path, purpose, upload, delete, validate=None):
+        """
+        Return the id of an uploaded file with the same content and purpose
+        as `file_path`, taking a reference to it. If there is none, the file
+        is uploaded with `upload(file_path, purpose)`, which must return the
+        new file id. If `validate(file_id)` is given and returns False, the
+        indexed file is considered gone and uploaded again.
+        """
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self.lock, self.connection:
+            file_id = self._acquire(digest, purpose)
+        if file_id is not None:
+            if validate is None or validate(file_id):
+                return file_id
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+        file_id = upload(file_path, purpose)
+        with self.lock, self.connection:
+            existing = self._acquire(digest, purpose)
+            if existing is None:
+                self.connection.execute(
+                    "INSERT INTO uploads (digest, purpose, file_id, refcount) VALUES (?, ?, ?, 1)",
+                    (digest, purpose, file_id)
+                )
+        if existing is not None:
+            # The same content was uploaded concurrently; keep the first copy.
+            delete(file_id)
+            return existing
+        return file_id
+
+    def release(self, file_id, delete):
+        """
+        Drop a reference to an uploaded file, deleting it with
+        `delete(file_id)` when the last reference goes away. Files that are
+        not in the index are deleted right away.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT refcount FROM uploads WHERE file_id = ?", (file_id,)
+            ).fetchone()
+            if row is not None and row[0] > 1:
+                self.connection.execute("UPDATE uploads SET refcount = refcount - 1 WHERE file_id = ?", (file_id,))
+                return False
+            self.connection.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+        delete(file_id)
+        return True
@@ -13,6 +13,20 @@ setup(
     description="An opinionated tool for managing your chatbot projects",
     url="https://github.com/sbslee/canu",
     packages=find_packages(),
+    install_requires=[
+        "streamlit",
+        "streamlit-authenticator",
+        "openai",
+        "pyyaml",
+    ],
+    extras_require={
+        "s3": ["boto3"],
+        "mysql": ["mysql-connector-python"],
+        "xls": ["xlrd", "openpyxl", "lxml"],
+        "hwp": ["pyhwp"],
+        "web": ["langchain-google-community"],
+        "all": ["boto3", "mysql-connector-python", "xlrd", "openpyxl", "lxml", "pyhwp", "langchain-google-community"],
+    },
     license="MIT",
     long_description=long_description,
     long_description_content_type="text/markdown"
@@ -0,0 +1,138 @@
+import sys, json, time, types, importlib
+from types import SimpleNamespace
+import pytest
+from canu import functions
+
+# The package exports functions of the same names as these modules.
+generate_image = importlib.import_module("canu.functions.generate_image")
+retrieve_from_web = importlib.import_module("canu.functions.retrieve_from_web")
+
+class FakeSearch():
+    def __init__(self):
+        self.queries = []
+
+    def run(self, query):
+        self.queries.append(query)
+        return f"Results for {query}"
+
+class FakeImages():
+    def __init__(self):
+        self.prompts = []
+
+    def generate(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return SimpleNamespace(data=[SimpleNamespace(url=f"https://example.com/{len(self.prompts)}.png")])
+
+@pytest.fixture(autouse=True)
+def reset():
+    yield
+    for name in functions.registry:
+        functions.disable_cache(name)
+    functions.registry.pop("add", None)
+    functions.registry.pop("today", None)
+    generate_image.set_client(None)
+    retrieve_from_web.set_client(None)
+
+@pytest.fixture
+def search():
+    client = FakeSearch()
+    retrieve_from_web.set_client(client)
+    return client
+
+@pytest.fixture
+def images():
+    client = SimpleNamespace(images=FakeImages())
+    generate_image.set_client(client)
+    return client.images
+
+def test_search_client_is_created_once(monkeypatch):
+    created = []
+    module = types.ModuleType("langchain_google_community")
+    module.GoogleSearchAPIWrapper = lambda: created.append(FakeSearch()) or created[-1]
+    monkeypatch.setitem(sys.modules, "langchain_google_community", module)
+    retrieve_from_web.set_client(None)
+    functions.call("retrieve_from_web", '{"query": "a"}')
+    functions.call("retrieve_from_web", '{"query": "b"}')
+    assert len(created) == 1
+    assert created[0].queries == ["a", "b"]
+
+def test_image_client_is_created_once(monkeypatch):
+    created = []
+    monkeypatch.setattr(generate_image.openai, "OpenAI", lambda: created.append(SimpleNamespace(images=FakeImages())) or created[-1])
+    generate_image.set_client(None)
+    functions.call("generate_image", '{"prompt": "a cat"}')
+    functions.call("generate_image", '{"prompt": "a dog"}')
+    assert len(created) == 1
+    assert created[0].images.prompts == ["a cat", "a dog"]
+
+def test_set_client(search, images):
+    assert functions.call("retrieve_from_web", '{"query": "canu"}') == "Results for canu"
+    assert functions.call("generate_image", '{"prompt": "a cat"}') == "https://example.com/1.png"
+    assert search.queries == ["canu"]
+    assert images.prompts == ["a cat"]
+
+def test_no_cache_by_default(search):
+    functions.call("retrieve_from_web", '{"query": "canu"}')
+    functions.call("retrieve_from_web", '{"query": "canu"}')
+    assert search.queries == ["canu", "canu"]
+
+def test_cache_ignores_whitespace(search):
+    functions.enable_cache("retrieve_from_web")
+    first = functions.call("retrieve_from_web", '{"query": "canu"}')
+    second = functions.call("retrieve_from_web", '{ "query" :  "  canu\\n" }')
+    assert first == second
+    assert search.queries == ["canu"]
+
+def test_cache_ignores_argument_order():
+    calls = []
+    def add(a, b):
+        calls.append((a, b))
+        return {"sum": a + b}
+    functions.register({"name": "add", "parameters": {}}, add)
+    functions.enable_cache("add")
+    assert functions.call("add", '{"a": 1, "b": 2}') == json.dumps({"sum": 3})
+    assert functions.call("add", '{"b": 2, "a": 1}') == json.dumps({"sum": 3})
+    assert calls == [(1, 2)]
+
+def test_cache_expires(images):
+    functions.enable_cache("generate_image", ttl=0.05)
+    first = functions.call("generate_image", '{"prompt": "a cat"}')
+    assert functions.call("generate_image", '{"prompt": "a cat"}') == first
+    time.sleep(0.1)
+    assert functions.call("generate_image", '{"prompt": "a cat"}') != first
+    assert images.prompts == ["a cat", "a cat"]
+
+def test_disk_cache(search, tmp_path):
+    functions.enable_cache("retrieve_from_web", path=str(tmp_path))
+    functions.call("retrieve_from_web", '{"query": "canu"}')
+    assert len(list(tmp_path.iterdir())) == 1
+    # A new cache on the same path, e.g. after a restart, reuses the entry.
+    functions.enable_cache("retrieve_from_web", path=str(tmp_path))
+    assert functions.call("retrieve_from_web", '{"query": " canu"}') == "Results for canu"
+    assert search.queries == ["canu"]
+    assert functions.registry["retrieve_from_web"]["cache"].stats()["hits"] == 1
+
+def test_disk_cache_expires(search, tmp_path):
+    functions.enable_cache("retrieve_from_web", ttl=0.05, path=str(tmp_path))
+    functions.call("retrieve_from_web", '{"query": "canu"}')
+    time.sleep(0.1)
+    functions.call("retrieve_from_web", '{"query": "canu"}')
+    assert search.queries == ["canu", "canu"]
+
+def test_disk_cache_evicts(search, tmp_path):
+    functions.enable_cache("retrieve_from_web", max_entries=2, path=str(tmp_path))
+    for query in ["a", "b", "c"]:
+        functions.call("retrieve_from_web", json.dumps({"query": query}))
+        time.sleep(0.01)
+    assert functions.registry["retrieve_from_web"]["cache"].stats()["entries"] == 2
+    functions.call("retrieve_from_web", '{"query": "c"}')
+    assert search.queries == ["a", "b", "c"]
+
+def test_disk_cache_shared_by_functions(tmp_path):
+    functions.register({"name": "today", "parameters": {}}, lambda: "Monday")
+    functions.register({"name": "add", "parameters": {}}, lambda: "No numbers")
+    functions.enable_cache("today", path=str(tmp_path))
+    functions.enable_cache("add", path=str(tmp_path))
+    assert functions.call("today", "{}") == "Monday"
+    assert functions.call("add", "{}") == "No numbers"
+    assert functions.call("today", "{}") == "Monday"